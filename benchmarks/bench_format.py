@@ -0,0 +1,187 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Benchmarks the stages of the Formatter over the saved pages
+in benchmarks/corpus (a stub, a huge list, an article with norm
+data, a long article and a user page which gets skipped).
+
+Every page is formatted the way get_obj does it with all of
+FIELDS selected, links included, timing each stage on its own,
+and the best of all rounds is reported as milliseconds per stage
+and pages per second. With --save the results become the
+baseline; with --compare the run fails if a stage got slower
+than the baseline allows or the output of a page changed.
+
+Usage:
+    python benchmarks/bench_format.py [--rounds 5] [--formatter both]
+        [--save benchmarks/baseline.json | --compare benchmarks/baseline.json]
+        [--tolerance 0.25]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from io import StringIO
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree, html
+from format import FIELDS, Formatter
+from single_pass import SinglePassFormatter
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+FORMATTERS = {"classic": Formatter, "single_pass": SinglePassFormatter}
+STAGES = ("parse", "get_paragraphs_headings", "get_links", "get_categories",
+          "get_revision_id", "get_article_id", "get_norm_data", "raw_html", "json_dumps")
+# Stages faster than this may differ by this much, in ms, without failing
+SLACK = 0.05
+
+
+def load_corpus() -> List[Tuple[str, str]]:
+    pages = []
+    for name in sorted(os.listdir(CORPUS)):
+        if name.endswith(".html"):
+            with open(os.path.join(CORPUS, name), "r", encoding="utf-8") as file:
+                pages.append((name, file.read()))
+    return pages
+
+
+class StageTimer:
+
+    def __init__(self, formatter: Formatter):
+
+        self._formatter = formatter
+        self.times = dict.fromkeys(STAGES, 0.0)
+        # get_links runs inside get_paragraphs_headings, time it on its own
+        get_links = formatter._get_element_links
+
+        def timed_links(*args):
+            start = time.perf_counter()
+            try:
+                return get_links(*args)
+            finally:
+                self.times["get_links"] += time.perf_counter() - start
+
+        formatter._get_element_links = timed_links
+        # logging is not part of formatting and would only add disk noise
+        formatter.log = lambda e, type: None
+
+    def _time(self, stage: str, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.times[stage] += time.perf_counter() - start
+        return result
+
+    def format(self, page: str) -> str:
+        """Does what Formatter.get_obj does, stage by stage."""
+        f = self._formatter
+        f.title = "Benchmark"
+        f.tree = self._time("parse", etree.parse, StringIO(page), etree.HTMLParser())
+        links = self.times["get_links"]
+        paragraphs, h1 = self._time("get_paragraphs_headings", f.get_paragraphs_headings)
+        self.times["get_paragraphs_headings"] -= self.times["get_links"] - links
+        if not paragraphs and not h1:
+            return None
+        content = dict()
+        content["headings"] = h1
+        content["paragraphs"] = paragraphs
+        categories = self._time("get_categories", f.get_categories)
+        if not categories:
+            return None
+        content["categories"] = categories
+        content["revision_id"] = self._time("get_revision_id", f.get_revision_id)
+        content["article_id"] = self._time("get_article_id", f.get_article_id)
+        content["norm_data"] = self._time("get_norm_data", f.get_norm_data)
+        content["redirects"] = [h1.text.replace(" ", "_")]
+        content["raw_html"] = self._time("raw_html", lambda: str(html.tostring(f.tree)))
+        return self._time("json_dumps", f.serializer.dumps, content).decode("utf-8")
+
+
+def bench(cls, pages: List[Tuple[str, str]], rounds: int) -> Dict:
+    """Formats the corpus rounds times and keeps the fastest
+    time of every stage and of the whole corpus."""
+    best = dict.fromkeys(STAGES, float("inf"))
+    best_total = float("inf")
+    digests = dict()
+    # every field, so that no stage is left out
+    reference = cls(fields=FIELDS)
+    reference.log = lambda e, type: None
+    for _ in range(rounds):
+        timer = StageTimer(cls(fields=FIELDS))
+        for name, page in pages:
+            content = timer.format(page)
+            if name not in digests:
+                if content != reference.get_obj(StringIO(page), [], False):
+                    raise Exception(f"The benchmark no longer formats {name} like get_obj.")
+                digests[name] = hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+        for stage in STAGES:
+            best[stage] = min(best[stage], timer.times[stage])
+        best_total = min(best_total, sum(timer.times.values()))
+    return {"pages_per_sec": round(len(pages) / best_total, 2),
+            "stages_ms_per_page": {stage: round(best[stage] * 1000 / len(pages), 4) for stage in STAGES},
+            "digests": digests}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    failures = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["pages_per_sec"] < base["pages_per_sec"] * (1 - tolerance):
+            failures.append(f"{name}: {result['pages_per_sec']} pages/sec, baseline {base['pages_per_sec']}")
+        for stage, ms in result["stages_ms_per_page"].items():
+            allowed = base["stages_ms_per_page"][stage] * (1 + tolerance) + SLACK
+            if ms > allowed:
+                failures.append(f"{name}: {stage} takes {ms} ms, baseline {base['stages_ms_per_page'][stage]}")
+        for page, digest in result["digests"].items():
+            if base["digests"].get(page, digest) != digest:
+                failures.append(f"{name}: output of {page} changed")
+    return failures
+
+
+def report(results: Dict):
+    names = list(results)
+    print(f"{'stage (ms/page)':<26}" + "".join(f"{name:>14}" for name in names))
+    for stage in STAGES:
+        print(f"{stage:<26}" + "".join(f"{results[name]['stages_ms_per_page'][stage]:>14.3f}" for name in names))
+    print(f"{'pages/sec':<26}" + "".join(f"{results[name]['pages_per_sec']:>14.1f}" for name in names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the stages of the Formatter.")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--formatter", choices=list(FORMATTERS) + ["both"], default="both")
+    parser.add_argument("--save", help="write the results as baseline to this file")
+    parser.add_argument("--compare", help="fail if the results are worse than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much slower than the baseline a stage may be")
+    args = parser.parse_args()
+
+    pages = load_corpus()
+    names = list(FORMATTERS) if args.formatter == "both" else [args.formatter]
+    results = {name: bench(FORMATTERS[name], pages, args.rounds) for name in names}
+    report(results)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            failures = compare(results, json.load(file), args.tolerance)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
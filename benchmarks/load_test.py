@@ -0,0 +1,224 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Runs the Scraper against the simulated Wikipedia of
+sim_server.py and reports throughput, the latency of fetching
+a page (retries included), how often requests were repeated
+and how much memory the scraper and its workers used over time.
+
+The run takes place in a temporary directory with its own
+config.json (the repository's one pointed at the server), a
+title index of --titles generated titles, journal and store, so
+nothing of a real scrape is touched.
+
+Usage:
+    python benchmarks/load_test.py [--titles 2000] [--concurrency 100]
+        [--latency lognormal:0.05,0.8] [--error-rate 0.01] [--throttle-rate 0.01]
+        [--maintenance-rate 0.005] [--url http://host:port/wiki/]
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from multiprocessing import Process
+from typing import Dict, List
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, BENCHMARKS)
+
+from fetch import Fetcher
+from scraper import Scraper
+from sim_server import serve
+from title_index import write_index
+
+
+def rss(pid: int) -> int:
+    """Resident memory of a process in bytes (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def children(pid: int) -> List[int]:
+    pids = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", "r") as file:
+                pids.extend(int(child) for child in file.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+class MemorySampler(threading.Thread):
+
+    def __init__(self, interval: float = 1):
+
+        super().__init__(daemon=True)
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._start = time.monotonic()
+        # (seconds since start, scraper bytes, worker bytes)
+        self.samples = []
+
+    def run(self):
+        pid = os.getpid()
+        while not self._stopped.wait(self._interval):
+            workers = sum(rss(child) for child in children(pid))
+            self.samples.append((time.monotonic() - self._start, rss(pid), workers))
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class LatencyRecorder:
+
+    def __init__(self):
+
+        self.latencies = []
+        self.failed = 0
+
+    def install(self):
+        """Times every Fetcher.fetch, i.e. a page including all
+        of its retries."""
+        fetch = Fetcher.fetch
+        recorder = self
+
+        async def timed_fetch(fetcher, title):
+            start = time.monotonic()
+            page = await fetch(fetcher, title)
+            recorder.latencies.append(time.monotonic() - start)
+            if page is None:
+                recorder.failed += 1
+            return page
+
+        Fetcher.fetch = timed_fetch
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def server_stats(url: str) -> Dict[str, int]:
+    base = url.rsplit("/wiki/", 1)[0]
+    try:
+        with urllib.request.urlopen(base + "/stats", timeout=10) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except OSError:
+        return dict()
+
+
+def wait_for(url: str, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server_stats(url):
+            return
+        time.sleep(0.1)
+    raise Exception(f"The server at {url} did not come up.")
+
+
+def prepare(directory: str, args) -> str:
+    """Writes the config and the title index of a run."""
+    with open(os.path.join(REPOSITORY, "config.json"), "r") as file:
+        config = json.load(file)
+    config["titles_path"] = os.path.join(directory, "titles.idx")
+    config["state_path"] = os.path.join(directory, "Saved") + os.sep
+    config["save_path"] = os.path.join(directory, "Scraped") + os.sep
+    config["fetch"]["base_url"] = args.url
+    config["fetch"]["concurrency"] = args.concurrency
+    config["fetch"]["connections_per_host"] = args.concurrency
+    config["fetch"]["cache"]["mode"] = "off"
+    config["metrics"]["path"] = os.path.join(directory, "Stats") + os.sep
+    config["logging"]["path"] = os.path.join(directory, "Logs") + os.sep
+    config["scheduler"]["path"] = os.path.join(directory, "Saved", "queue.sqlite")
+    config["scheduler"]["address"] = ["127.0.0.1", args.port + 1]
+    config["fetch"]["retry"]["max_delay"] = args.max_delay
+    with open(os.path.join(directory, "config.json"), "w") as file:
+        json.dump(config, file, indent=2)
+    write_index(config["titles_path"], {f"Seite_{number}": [] for number in range(args.titles)})
+    return directory
+
+
+def report(elapsed: float, recorder: LatencyRecorder, stats: Dict[str, int], sampler: MemorySampler, titles: int):
+    latencies = recorder.latencies
+    print(f"titles            {titles}")
+    print(f"elapsed           {elapsed:.1f} s")
+    print(f"throughput        {len(latencies) / elapsed:.1f} pages/s")
+    print("latency           " + "  ".join(f"p{int(share * 100)} {percentile(latencies, share) * 1000:.0f} ms"
+                                           for share in (0.5, 0.9, 0.99)) +
+          f"  max {max(latencies, default=0) * 1000:.0f} ms")
+    print(f"failed            {recorder.failed}")
+    if stats:
+        print(f"requests          {stats.get('requests', 0)} (retries {stats.get('retries', 0)}, "
+              f"500 {stats.get('500', 0)}, 429 {stats.get('429', 0)}, maintenance {stats.get('maintenance', 0)})")
+    if sampler.samples:
+        print("memory (MiB)      second  scraper  workers")
+        step = max(1, len(sampler.samples) // 20)
+        for seconds, own, workers in sampler.samples[::step]:
+            print(f"                  {seconds:6.0f}  {own / 2**20:7.1f}  {workers / 2**20:7.1f}")
+        print(f"peak              {max(own for _, own, _ in sampler.samples) / 2**20:.1f} MiB scraper, "
+              f"{max(workers for _, _, workers in sampler.samples) / 2**20:.1f} MiB workers")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests the Scraper against a simulated Wikipedia.")
+    parser.add_argument("--titles", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--max-delay", type=float, default=30, help="longest wait between retries")
+    parser.add_argument("--url", help="use a server which is already running instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="lognormal:0.05,0.8")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--maintenance-rate", type=float, default=0.0)
+    parser.add_argument("--memory-interval", type=float, default=1)
+    args = parser.parse_args()
+
+    server = None
+    if not args.url:
+        args.url = f"http://127.0.0.1:{args.port}/wiki/"
+        server = Process(target=serve, args=(args.port,), daemon=True,
+                         kwargs={"latency": args.latency, "error_rate": args.error_rate,
+                                 "throttle_rate": args.throttle_rate,
+                                 "maintenance_rate": args.maintenance_rate})
+        server.start()
+    try:
+        wait_for(args.url)
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(prepare(directory, args))
+            recorder = LatencyRecorder()
+            recorder.install()
+            sampler = MemorySampler(args.memory_interval)
+            sampler.start()
+            start = time.monotonic()
+            Scraper("de", 1, 1).scrape()
+            elapsed = time.monotonic() - start
+            sampler.stop()
+            os.chdir(REPOSITORY)
+        report(elapsed, recorder, server_stats(args.url), sampler, args.titles)
+    finally:
+        if server:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
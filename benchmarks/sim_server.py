@@ -0,0 +1,139 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+A local stand-in for Wikipedia to tune the scraper against.
+
+Serves the pages of benchmarks/corpus at /wiki/<title>, every
+title always getting the same page. Answers are delayed by a
+configurable latency distribution, and a configurable share of
+them are 500 errors, 429s with a Retry-After header or the
+maintenance page Wikipedia shows when it is overloaded. /stats
+returns what was served so far as Json.
+
+Latencies are given as
+    fixed:<seconds>
+    uniform:<low>,<high>
+    lognormal:<median>,<sigma>
+
+Usage:
+    python benchmarks/sim_server.py [--port 8765] [--latency lognormal:0.05,0.8]
+        [--error-rate 0.01] [--throttle-rate 0.01] [--maintenance-rate 0.005]
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import random
+import zlib
+from collections import Counter
+from typing import Callable, Dict
+from aiohttp import web
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+MAINTENANCE_PAGE = ("<!DOCTYPE html><html lang=\"en\"><meta charset=\"utf-8\"><title>Wikimedia Error</title>"
+                    "<body><div class=\"content\"><h1>Error</h1><p>Our servers are currently under maintenance "
+                    "or experiencing a technical problem. Please <a href=\"\" title=\"Reload this page\">try "
+                    "again</a> in a few minutes.</p></div></body></html>")
+
+
+def latency_distribution(spec: str) -> Callable[[], float]:
+    """Turns a latency given as kind:parameters into a function
+    returning one latency in seconds per call."""
+    kind, _, parameters = spec.partition(":")
+    values = [float(value) for value in parameters.split(",") if value]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(*values)
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    raise Exception(f"Unknown latency {spec}.")
+
+
+class SimulatedWikipedia:
+
+    def __init__(self,
+                 latency: str = "lognormal:0.05,0.8",
+                 error_rate: float = 0.0,
+                 throttle_rate: float = 0.0,
+                 maintenance_rate: float = 0.0,
+                 retry_after: int = 1
+                 ):
+
+        self._latency = latency_distribution(latency)
+        self._error_rate = error_rate
+        self._throttle_rate = throttle_rate
+        self._maintenance_rate = maintenance_rate
+        self._retry_after = retry_after
+        self._pages = []
+        for name in sorted(os.listdir(CORPUS)):
+            if name.endswith(".html"):
+                with open(os.path.join(CORPUS, name), "r", encoding="utf-8") as file:
+                    self._pages.append(file.read())
+        self.stats = Counter()
+        self.titles = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/wiki/{title:.+}", self._page)
+        app.router.add_get("/stats", self._stats)
+        return app
+
+    async def _page(self, request: web.Request) -> web.Response:
+        title = request.match_info["title"]
+        self.stats["requests"] += 1
+        self.titles[title] += 1
+        await asyncio.sleep(self._latency())
+        chance = random.random()
+        if chance < self._error_rate:
+            self.stats["500"] += 1
+            return web.Response(status=500, text="Internal Server Error")
+        chance -= self._error_rate
+        if chance < self._throttle_rate:
+            self.stats["429"] += 1
+            return web.Response(status=429, text="Too Many Requests",
+                                headers={"Retry-After": str(self._retry_after)})
+        chance -= self._throttle_rate
+        if chance < self._maintenance_rate:
+            self.stats["maintenance"] += 1
+            return web.Response(status=200, text=MAINTENANCE_PAGE, content_type="text/html")
+        self.stats["200"] += 1
+        page = self._pages[zlib.crc32(title.encode("utf-8")) % len(self._pages)]
+        return web.Response(text=page, content_type="text/html")
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        stats: Dict[str, int] = dict(self.stats)
+        stats["titles"] = len(self.titles)
+        stats["retries"] = self.stats["requests"] - len(self.titles)
+        return web.json_response(stats)
+
+
+def serve(port: int = 8765, host: str = "127.0.0.1", **options):
+    web.run_app(SimulatedWikipedia(**options).app(), host=host, port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the corpus like Wikipedia would.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="lognormal:0.05,0.8")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--maintenance-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    print(f"Serving on http://{args.host}:{args.port}/wiki/")
+    serve(args.port, args.host, latency=args.latency, error_rate=args.error_rate,
+          throttle_rate=args.throttle_rate, maintenance_rate=args.maintenance_rate,
+          retry_after=args.retry_after)
+
+
+if __name__ == "__main__":
+    main()
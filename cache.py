@@ -0,0 +1,109 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+On-disk cache of fetched Wikipedia pages.
+
+Page bodies are stored compressed under the SHA-256 of their
+content (objects/), so identical pages are kept once. For every
+URL a small reference file (refs/) names the body together with
+the ETag and Last-Modified the server sent, which are used to
+revalidate the page with a conditional request.
+
+Modes:
+    "off"         no caching
+    "revalidate"  ask the server whether a cached page changed
+    "offline"     only serve cached pages, never touch the network
+"""
+
+import hashlib
+import json
+import os
+import threading
+import zlib
+from typing import Any, Dict, NamedTuple, Optional
+from urllib.parse import quote
+
+MODES = ("off", "revalidate", "offline")
+
+
+def page_url(language: str, title: str, base_url: Optional[str] = None) -> str:
+    """The URL of an article, which is also its key in the cache.
+    Every path that fetches pages builds it here, so they share
+    cache entries."""
+    return (base_url if base_url else f"https://{language}.wikipedia.org/wiki/") + quote(title)
+
+
+class CachedPage(NamedTuple):
+    text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class ResponseCache:
+
+    def __init__(self, path: str, mode: str = "revalidate"):
+
+        if mode not in MODES:
+            raise Exception(f"Cache mode must be one of {str(MODES)[1:-1]}.")
+        self._path = path
+        self.mode = mode
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional["ResponseCache"]:
+        """Builds the cache of the "cache" section of config.json,
+        None if it is off."""
+        return cls(**config) if config["mode"] != "off" else None
+
+    @property
+    def offline(self) -> bool:
+        return self.mode == "offline"
+
+    def _file(self, kind: str, digest: str) -> str:
+        return os.path.join(self._path, kind, digest[:2], digest)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        """Writes a file atomically so readers never see half of it."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # one per thread, two threads may write the same entry
+        temporary = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+    def lookup(self, url: str) -> Optional[CachedPage]:
+        ref = self._file("refs", hashlib.sha256(url.encode("utf-8")).hexdigest())
+        try:
+            with open(ref, "r", encoding="utf-8") as file:
+                entry = json.load(file)
+            with open(self._file("objects", entry["object"]), "rb") as file:
+                text = zlib.decompress(file.read()).decode("utf-8")
+        except (FileNotFoundError, ValueError, zlib.error):
+            return None
+        return CachedPage(text, entry["etag"], entry["last_modified"])
+
+    def store(self, url: str, text: str, etag: Optional[str], last_modified: Optional[str]):
+        body = text.encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()
+        obj = self._file("objects", digest)
+        if not os.path.exists(obj):
+            self._write(obj, zlib.compress(body))
+        entry = {"url": url, "object": digest, "etag": etag, "last_modified": last_modified}
+        self._write(self._file("refs", hashlib.sha256(url.encode("utf-8")).hexdigest()),
+                    json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+
+    @staticmethod
+    def conditional_headers(page: Optional[CachedPage]) -> Dict[str, str]:
+        """Headers which let the server answer 304 Not Modified
+        if the cached page is still current."""
+        headers = dict()
+        if page and page.etag:
+            headers["If-None-Match"] = page.etag
+        if page and page.last_modified:
+            headers["If-Modified-Since"] = page.last_modified
+        return headers
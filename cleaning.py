@@ -0,0 +1,101 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Precompiled text cleaning for the Formatter.
+
+Citations like [23] and escaped line breaks are removed in one
+regex pass instead of one pass each, IPA transcriptions are only
+searched for where a transcription can be, and html entities are
+decoded without starting an html parser. clean_texts cleans all
+paragraphs of an article with a single pass over their joined
+text. Results are the same as those of the separate passes;
+strings where a shortcut could differ take the old way.
+"""
+
+import re
+from typing import List
+from bs4 import BeautifulSoup
+
+CITATIONS = re.compile(r"(?:\[\d+])+")
+LINE_BREAKS = re.compile(r"\\n")
+CITATIONS_LINE_BREAKS = re.compile(r"(?:\[\d+])+|\\n")
+PHONETIC = re.compile(r"(?:/|\[)\.mw.*?\.IPA.*?}(.*?)(?:/|])")
+CATEGORY = re.compile("<li><a href=\"(.*?)\" title=\"(.*?)\">(.*?)</a></li>")
+
+_ENTITY = re.compile(r"&(?:#(\d{1,7})|#[xX]([0-9a-fA-F]{1,6})|(amp|lt|gt|quot));")
+_NAMED = {"amp": "&", "lt": "<", "gt": ">", "quot": "\""}
+
+
+def clean_phonetic(text: str) -> str:
+    if ".mw" not in text:
+        return text
+    return PHONETIC.sub("", text)
+
+
+def _clean(text: str) -> str:
+    # Removing a citation between a backslash and an n would make
+    # a line break the separate passes remove, one pass would not.
+    if "\\[" in text:
+        text = LINE_BREAKS.sub("", CITATIONS.sub("", text))
+    else:
+        text = CITATIONS_LINE_BREAKS.sub("", text)
+    return clean_phonetic(text)
+
+
+def clean_text(text: str) -> str:
+    """Cleans the text of a paragraph as returned by get_text
+    on the html of its element: removes citations, line breaks,
+    the leading b' and trailing ' and IPA transcriptions."""
+    return _clean(text[2:-1])
+
+
+def clean_texts(texts: List[str]) -> List[str]:
+    """Cleans the texts of all paragraphs of an article at once.
+    The texts are joined by real line breaks, which the escaped
+    texts do not contain and none of the patterns can cross."""
+    if not texts:
+        return []
+    joined = "\n".join(text[2:-1] for text in texts)
+    if joined.count("\n") != len(texts) - 1:
+        return [clean_text(text) for text in texts]
+    return _clean(joined).split("\n")
+
+
+class _Irregular(Exception):
+    pass
+
+
+def _decode(match_obj) -> str:
+    decimal, hexadecimal, name = match_obj.groups()
+    if name:
+        return _NAMED[name]
+    code = int(decimal) if decimal else int(hexadecimal, 16)
+    # BeautifulSoup treats these differently from their characters
+    if code < 32 or 0x7f <= code < 0xa0 or 0xd800 <= code < 0xe000 or code > 0x10ffff:
+        raise _Irregular()
+    return chr(code)
+
+
+def decode_entities(text: str) -> str:
+    """Decodes the html entities of a string and escapes &, < and >
+    again, the same as str(BeautifulSoup(text, 'html.parser')). The
+    entities lxml writes are decoded directly; markup, other entities
+    and whitespace-only strings are left to BeautifulSoup."""
+    if "<" in text or "\r" in text or text.isspace():
+        return str(BeautifulSoup(text, "html.parser"))
+    if "&" in text:
+        if text.count("&") != len(_ENTITY.findall(text)):
+            return str(BeautifulSoup(text, "html.parser"))
+        try:
+            decoded = _ENTITY.sub(_decode, text)
+        except _Irregular:
+            return str(BeautifulSoup(text, "html.parser"))
+        if decoded.isspace():
+            return str(BeautifulSoup(text, "html.parser"))
+        text = decoded
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
@@ -1,14 +1,24 @@
-import sys
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Stops the scrape started by main.py. The workers write the
+pages they already fetched before they exit.
+"""
+
 import json
-import os
+from supervisor import stop_supervisor
+
 
 class Close:
 
     def __init__(self):
 
         self._config = self._load_config()
-        self.no_of_scripts = int(sys.argv[1])
-        self.command = self.get_command()
         self.run_command()
 
     @staticmethod
@@ -17,12 +27,9 @@ class Close:
             return json.loads(str(file.read()))
 
     def run_command(self):
-        os.system(self.command)
-
-    def get_command(self):
-        path = self._config["commands_path"] + "stop_command.txt"
-        with open(path, "r+") as file:
-            command = file.read().replace("no_of_scripts", str(self.no_of_scripts))
-        return command
-        
-c = Close()
\ No newline at end of file
+        if not stop_supervisor(self._config["state_path"]):
+            print("No scrape is running.")
+
+
+if __name__ == "__main__":
+    c = Close()
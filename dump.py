@@ -0,0 +1,81 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Streaming reader for the MySQL dumps Wikipedia publishes
+(e.g. dewiki-20191001-page.sql). Rows of the INSERT lines are
+tokenized and yielded one by one instead of evaluating whole
+lines, and a dump can be split at line boundaries so several
+processes read it at the same time.
+"""
+
+import os
+import re
+from typing import Iterator, List, Optional, Tuple
+
+_TOKEN = re.compile(r"'((?:[^'\\]|\\.)*)'|(NULL)|([-+.0-9eE]+)|(\()|(\))", re.S)
+_ESCAPE = re.compile(r"\\(.)", re.S)
+_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+
+
+def _unescape(match_obj) -> str:
+    char = match_obj.group(1)
+    return _ESCAPES.get(char, char)
+
+
+def parse_values(values: str) -> Iterator[tuple]:
+    """Yields the tuples of the VALUES part of an INSERT line.
+    Strings are unescaped, numbers converted and NULL is None."""
+    row = None
+    for match_obj in _TOKEN.finditer(values):
+        string, null, number, opening, closing = match_obj.groups()
+        if opening:
+            row = []
+        elif closing:
+            yield tuple(row)
+            row = None
+        elif row is None:
+            continue
+        elif string is not None:
+            row.append(_ESCAPE.sub(_unescape, string) if "\\" in string else string)
+        elif null:
+            row.append(None)
+        elif "." in number or "e" in number or "E" in number:
+            row.append(float(number))
+        else:
+            row.append(int(number))
+
+
+def iter_rows(path: str, table: str, start: int = 0, end: Optional[int] = None) -> Iterator[tuple]:
+    """Yields the rows of all INSERT lines for the given table
+    which start between the byte offsets start and end."""
+    prefix = f"INSERT INTO `{table}` VALUES ".encode("utf-8")
+    with open(path, "rb") as file:
+        file.seek(start)
+        position = start
+        for line in file:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            if line.startswith(prefix):
+                yield from parse_values(line[len(prefix):].decode("utf-8"))
+
+
+def split(path: str, parts: int) -> List[Tuple[int, int]]:
+    """Splits a dump into byte ranges which start at the
+    beginning of a line."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as file:
+        for part in range(1, parts):
+            offset = max(size * part // parts, bounds[-1])
+            file.seek(offset)
+            if offset:
+                file.readline()
+            bounds.append(min(file.tell(), size))
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
@@ -0,0 +1,193 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Asynchronous fetch engine for Wikipedia articles.
+Keeps a pool of keep-alive connections per host and a
+bounded number of requests in flight, so one process can
+scrape as fast as several terminal windows used to.
+"""
+
+import asyncio
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Optional, Tuple, Union
+import aiohttp
+from cache import ResponseCache, page_url
+from metrics import REGISTRY
+from ratelimit import RateLimiter, RetryPolicy
+
+try:
+    import brotli  # noqa: F401 aiohttp decodes br only if this is installed
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+MAINTENANCE = "Our servers are currently under maintenance or experiencing"
+# Answers which mean the servers want fewer requests
+THROTTLING = (429, 503)
+
+REQUESTS = REGISTRY.counter("wiki_fetch_requests_total", "Requests sent, by status", ["status"])
+REQUEST_SECONDS = REGISTRY.histogram("wiki_fetch_request_seconds", "Duration of a single request")
+PAGES = REGISTRY.counter("wiki_fetch_pages_total", "Pages fetched, by result", ["result"])
+BYTES_IN = REGISTRY.counter("wiki_fetch_bytes_total", "Bytes of the response bodies received")
+
+
+async def iterate(items: Union[Iterable, AsyncIterable]) -> AsyncIterator:
+    """Iterates over a plain or an asynchronous iterable."""
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+class Fetcher:
+
+    def __init__(self,
+                 language: str = "de",
+                 concurrency: int = 100,
+                 connections_per_host: int = 100,
+                 connect_timeout: float = 10,
+                 read_timeout: float = 30,
+                 limiter: RateLimiter = None,
+                 retry: RetryPolicy = None,
+                 cache: ResponseCache = None,
+                 base_url: str = None
+                 ):
+
+        self._language = language
+        self._concurrency = concurrency
+        self._connections_per_host = connections_per_host
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                              sock_read=read_timeout)
+        self._session = None
+        self._limiter = limiter if limiter else RateLimiter()
+        self._retry = retry if retry else RetryPolicy()
+        self._cache = cache
+        self._base_url = base_url
+
+    @classmethod
+    def from_config(cls, language: str, config: Dict[str, Any], scripts: int = 1) -> "Fetcher":
+        """Builds a fetcher from the "fetch" section of config.json.
+        The rate limit holds for the scripts on one machine together,
+        so each of them gets its share of rate and max_rate."""
+        limits = dict(config["rate_limit"])
+        for key in ("rate", "max_rate"):
+            limits[key] = max(limits["min_rate"], limits[key] / scripts)
+        return cls(language,
+                   concurrency=config["concurrency"],
+                   connections_per_host=config["connections_per_host"],
+                   connect_timeout=config["connect_timeout"],
+                   read_timeout=config["read_timeout"],
+                   limiter=RateLimiter(**limits),
+                   retry=RetryPolicy(**config["retry"]),
+                   cache=ResponseCache.from_config(config["cache"]),
+                   base_url=config["base_url"])
+
+    async def __aenter__(self) -> "Fetcher":
+        connector = aiohttp.TCPConnector(limit=self._concurrency,
+                                         limit_per_host=self._connections_per_host)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              timeout=self._timeout,
+                                              headers={"Accept-Encoding": ACCEPT_ENCODING})
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+        self._session = None
+
+    def url(self, title: str) -> str:
+        return page_url(self._language, title, self._base_url)
+
+    async def fetch(self, title: str) -> Optional[str]:
+        """Requests the article with the given title and returns
+        its HTML, or None if all retries failed. With a cache, a
+        cached page is revalidated with a conditional request, or
+        served without asking the server at all in offline mode."""
+        url = self.url(title)
+        cached = await asyncio.to_thread(self._cache.lookup, url) if self._cache else None
+        if self._cache and self._cache.offline:
+            PAGES.inc(result="cached" if cached else "not_cached")
+            return cached.text if cached else None
+        headers = ResponseCache.conditional_headers(cached)
+        for attempt in range(self._retry.retries + 1):
+            await self._limiter.acquire()
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                async with self._session.get(url, headers=headers) as response:
+                    status = response.status
+                    retry_after = RetryPolicy.retry_after(response.headers.get("Retry-After"))
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                    body = await response.read()
+                    text = body.decode(response.get_encoding())
+                BYTES_IN.inc(len(body))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                status, text = None, ""
+            REQUEST_SECONDS.observe(time.perf_counter() - start)
+            if status is not None and MAINTENANCE in text:
+                REQUESTS.inc(status="maintenance")
+            else:
+                REQUESTS.inc(status=status if status is not None else "error")
+            if status == 304 and cached:
+                self._limiter.success()
+                PAGES.inc(result="not_modified")
+                return cached.text
+            if status in THROTTLING or MAINTENANCE in text:
+                self._limiter.throttle(retry_after or 0)
+            elif status is not None and status < 500:
+                self._limiter.success()
+                if self._cache and status == 200:
+                    await asyncio.to_thread(self._cache.store, url, text, etag, last_modified)
+                PAGES.inc(result="fetched")
+                return text
+            if attempt < self._retry.retries:
+                await asyncio.sleep(self._retry.delay(attempt, retry_after))
+        PAGES.inc(result="failed")
+        return None
+
+    async def fetch_all(self, items: Union[Iterable[Tuple[str, Any]], AsyncIterable[Tuple[str, Any]]]
+                        ) -> AsyncIterator[Tuple[str, Any, Optional[str]]]:
+        """Fetches (title, payload) pairs with at most `concurrency`
+        requests in flight and yields (title, payload, html) in the
+        order the responses arrive, so one slow page never holds
+        back the ones behind it. items may be asynchronous and wait
+        for more work; the responses keep coming meanwhile."""
+        in_flight = dict()
+        # finished requests, None once items are exhausted
+        arrived = asyncio.Queue()
+        slots = asyncio.Semaphore(self._concurrency)
+
+        async def feed():
+            try:
+                async for title, payload in iterate(items):
+                    await slots.acquire()
+                    task = asyncio.ensure_future(self.fetch(title))
+                    in_flight[task] = (title, payload)
+                    task.add_done_callback(arrived.put_nowait)
+            finally:
+                arrived.put_nowait(None)
+
+        feeder = asyncio.ensure_future(feed())
+        fed = False
+        try:
+            while not fed or in_flight:
+                task = await arrived.get()
+                if task is None:
+                    fed = True
+                    # raises what iterating over items raised
+                    await feeder
+                    continue
+                title, payload = in_flight.pop(task)
+                slots.release()
+                yield title, payload, task.result()
+        finally:
+            feeder.cancel()
+            for task in in_flight:
+                task.cancel()
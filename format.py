@@ -8,26 +8,121 @@ September 2019
 
 Format raw Wikipedia HTML into Heading and Paragraph
 objects which can be further processed by Jsonizer.
+
+Which fields a page is written with is chosen by "fields" in
+config.json, null meaning all of FIELDS but links. A field which
+is not selected is never computed, and the selected ones only
+when the page is serialized. incremental.py needs revision_id.
+links are written with each paragraph, so they need paragraphs. Pages are
+serialized by serialize.py, straight from the Heading and
+Paragraph objects.
 """
 
 from lxml import etree, html
 from bs4 import BeautifulSoup, Comment
 import re
 import requests
-from typing import Dict, List, Optional
-from wiki_objects import Heading, Paragraph, Skips
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from wiki_objects import Heading, Links, Paragraph, Skips
+from serialize import Serializer
+from ratelimit import RateLimiter, RetryPolicy
+from cache import ResponseCache, page_url
+from cleaning import CATEGORY, clean_phonetic, clean_text, clean_texts, decode_entities
+from logger import LOGGER
+from metrics import REGISTRY
 from io import StringIO
 import json
 from time import sleep
 
+HEADING_XPATH = "//h1[@class='firstHeading']"
+CONTENT_XPATH = "//div[@class='mw-parser-output']"
+CATEGORIES_XPATH = "//*[@id='mw-normal-catlinks']/ul"
+NORM_DATA_XPATH = "//*[@id='normdaten']"
+ARTICLE_ID_XPATH = "//*[@id='t-wikibase']"
+# in the order they are written
+FIELDS = ("headings", "paragraphs", "links", "categories", "revision_id",
+          "article_id", "norm_data", "redirects", "raw_html")
+# the links of a page are most of its paragraphs, so only on request
+DEFAULT_FIELDS = tuple(field for field in FIELDS if field != "links")
+
+PARSE_SECONDS = REGISTRY.histogram("wiki_format_parse_seconds", "Time to parse the HTML of a page")
+EXTRACT_SECONDS = REGISTRY.histogram("wiki_format_extract_seconds", "Time to extract the content of a page")
+SERIALIZE_SECONDS = REGISTRY.histogram("wiki_format_serialize_seconds", "Time to dump a page to Json")
+# log types of Formatter.log and the reasons they are logged with
+LOG_REASONS = {"w": ("skipped_file", "Skipping whole file %s."),
+               "p": ("skipped_paragraph", "Skipping 1 paragraph in %s."),
+               "a": ("missing_article_id", "Skipping article_id in %s.")}
+
+SKIPS = REGISTRY.counter("wiki_format_skipped_total", "Pages the formatter skipped, by reason", ["reason"])
+
+
+class LazyContent(Mapping):
+    """The fields of one page. Each is computed by its getter the
+    first time it is accessed, which has to happen before the
+    Formatter moves on to the next page."""
+
+    def __init__(self, getters: Dict[str, Callable[[], Any]]):
+
+        self._getters = getters
+        self._values = dict()
+
+    def __getitem__(self, field: str) -> Any:
+        if field not in self._values:
+            self._values[field] = self._getters[field]()
+        return self._values[field]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._getters)
+
+    def __len__(self) -> int:
+        return len(self._getters)
+
 
 class Formatter:
 
-    def __init__(self, language="de"):
+    def __init__(self, language="de", fields: Optional[Iterable[str]] = None, serializer: str = "json"):
 
         self.language = language
+        self.fields = self.select_fields(fields)
+        self.serializer = Serializer(serializer)
         self.tree = None
         self.title = None
+        self.limiter = RateLimiter()
+        self.retry = RetryPolicy()
+        self.cache = None
+        self.base_url = None
+        # (connect, read) seconds
+        self.timeout = (10, 30)
+        self._skips = Skips().pattern(language)
+        # link targets and heading texts of the current article
+        self._strings = dict()
+
+    @classmethod
+    def from_config(cls, language: str, config: Dict[str, Any], **kwargs) -> "Formatter":
+        """Builds a formatter which fetches pages itself, see
+        format_with_title, from the "fetch" section of config.json."""
+        formatter = cls(language, **kwargs)
+        formatter.limiter = RateLimiter(**config["rate_limit"])
+        formatter.retry = RetryPolicy(**config["retry"])
+        formatter.cache = ResponseCache.from_config(config["cache"])
+        formatter.base_url = config["base_url"]
+        formatter.timeout = (config["connect_timeout"], config["read_timeout"])
+        return formatter
+
+    @staticmethod
+    def select_fields(fields: Optional[Iterable[str]]) -> Tuple[str, ...]:
+        """Returns the selected fields in the order of FIELDS,
+        DEFAULT_FIELDS if fields is None."""
+        if fields is None:
+            return DEFAULT_FIELDS
+        fields = set(fields)
+        unknown = fields.difference(FIELDS)
+        if unknown:
+            raise Exception(f"Unknown fields {', '.join(sorted(unknown))}.")
+        if "links" in fields and "paragraphs" not in fields:
+            raise Exception("The links field is written with the paragraphs, select those too.")
+        return tuple(field for field in FIELDS if field in fields)
 
     @staticmethod
     def format_heading(text: str) -> str:
@@ -41,7 +136,7 @@ class Formatter:
     def clean_html_encodings(text: str) -> str:
         """Gets text in html format and returns it having
         decoded all html encodings."""
-        return str(BeautifulSoup(text, 'html.parser'))
+        return decode_entities(text)
 
     @staticmethod
     def filter_tags(tag: str) -> bool:
@@ -50,13 +145,16 @@ class Formatter:
         valid = ["p", "h2", "h3", "h4", "h5", "h6", "ul"]
         return tag in valid
 
-    def get_links(self, text_html: str, text: str) -> List[Dict[str, str]]:
+    def get_links(self, text_html: str, text: str) -> Links:
         """Gets the links from the passed text."""
         soup = BeautifulSoup(text_html, 'html.parser')
         hrefs = [(href.text, href['href'], href['title'])
                  for href in soup.find_all('a') if href.get('title')]
+        return self._get_link_offsets(hrefs, text)
 
-        hyperlinks = []
+    def _get_link_offsets(self, hrefs: List[Tuple[str, str, str]], text: str) -> Links:
+        """Locates (display name, link, title) triples in the text."""
+        hyperlinks = Links(text, self._strings)
         for (href_text, link, title) in hrefs:
             # skips phonetic link
             if title == "Liste der IPA-Zeichen":
@@ -68,53 +166,38 @@ class Formatter:
                 self.log(e, "p")
                 continue
             end = start + len(href_text)
-            hyperlinks.append({'link': link,
-                               'display_name': href_text,
-                               'article_name': title,
-                               'start': start,
-                               'end': end})
+            hyperlinks.append(link, title, start, end)
 
         return hyperlinks
 
     def log(self, e: Exception, type: str):
-        msg = ""
-        if type == "w":
-            msg = f"\nSkipping whole file {self.title}\n"
-        if type == "p":
-            msg= f"\nSkipping 1 paragraph in {self.title}.\n"
-        if type == "a":
-            msg= f"\nSkipping article_id in {self.title}.\n"
-        with open("log.txt", "a") as file:
-            file.write(msg)
+        """Queues a log record, see logger.py."""
+        reason, msg = LOG_REASONS[type]
+        LOGGER.warning(msg, self.title,
+                       extra={"title": self.title, "reason": reason,
+                              "error": repr(e) if e is not None else None})
 
     def skip(self, heading: str) -> bool:
         """Checks if the current heading or paragraph should
         be skipped."""
-        skip_flag = False
-        for skip in Skips().get(self.language):
-            if skip in heading:
-                skip_flag = True
-        return skip_flag
+        return self._skips.search(heading) is not None
 
     def format_categories(self, cat: str) -> Dict[str, str]:
         """Turn raw category html into a dict."""
-        regex = "<li><a href=\"(.*?)\" title=\"(.*?)\">(.*?)</a></li>"
         cats = [{"link": x[0],
                  "category_name": self.clean_html_encodings(x[1]),
                  "display_name": self.clean_html_encodings(x[2])}
-                for x in re.compile(regex).findall(cat)][0]
+                for x in CATEGORY.findall(cat)][0]
         return cats
 
     @staticmethod
     def clean_phonetic(text: str) -> str:
-        regex = r"(?:/|\[)\.mw.*?\.IPA.*?}(.*?)(?:/|])"
         # Currently replacing completely
         # Can be changed to phonetic string
         # group(1) is the capturing group of the actual
         # group. re.search(regex, t).group(1) returns
         # dɒnəld d͡ʒɒn trʌmp for Donald John Trump.
-        text = re.sub(regex, "", text)
-        return text
+        return clean_phonetic(text)
 
     @staticmethod
     def clean_noprints(soup: BeautifulSoup) -> BeautifulSoup:
@@ -135,9 +218,13 @@ class Formatter:
             paragraph["text"] = para.text
 
             # add headings
-            for i in range(1, 7):
-                if eval(f"para.h{i}"):
-                    paragraph[f"h{i}"] = eval(f"para.h{i}.text")
+            for i, heading in enumerate(para.headings, 1):
+                if heading:
+                    paragraph[f"h{i}"] = heading.text
+
+            # add links, if they were extracted
+            if para.links is not None:
+                paragraph["links"] = para.links.to_list()
 
             # add if skippable
             paragraph["is_skippable"] = para.is_skippable
@@ -148,11 +235,11 @@ class Formatter:
         """Remove indices like [23] from text.
         Remove line breaks.
         Remove leading b' and trailing '."""
-        text = re.sub(r"(?:\[\d+])+", "", text)
-        text = re.sub(r"\\n", "", text)
-        text = text[2:-1]
-        text = self.clean_phonetic(text)
-        return text
+        return clean_text(text)
+
+    def format_texts(self, texts: List[str]) -> List[str]:
+        """format_text for all paragraphs of an article at once."""
+        return clean_texts(texts)
 
     # def format_path(self, path: str, pretty_print: bool) -> str:
     #     """Formats a Wikipedia article. Expects the
@@ -167,13 +254,56 @@ class Formatter:
         exact name of the article and returns a string
         in Json format containing all relevant data."""
         self.title = title
-        url = f"https://{self.language}.wikipedia.org/wiki/" + title
-        r = requests.get(url).text
+        url = page_url(self.language, title, self.base_url)
+        cached = self.cache.lookup(url) if self.cache else None
+        if self.cache and self.cache.offline:
+            if cached is None:
+                self.log(None, "w")
+                return None
+            return self.format_html(title, cached.text, redirects, pretty_print)
         err_msg = "Our servers are currently under maintenance or experiencing"
-        if err_msg in r:
-            sleep(10)
-            self.format_with_title(title, redirects, pretty_print)
-        return self.get_obj(StringIO(r), redirects, pretty_print)
+        for attempt in range(self.retry.retries + 1):
+            self.limiter.acquire_blocking()
+            try:
+                response = requests.get(url, headers=ResponseCache.conditional_headers(cached),
+                                        timeout=self.timeout)
+            except requests.RequestException:
+                # no answer at all, backed off from like a server error
+                self.limiter.throttle()
+                if attempt < self.retry.retries:
+                    sleep(self.retry.delay(attempt, None))
+                continue
+            retry_after = RetryPolicy.retry_after(response.headers.get("Retry-After"))
+            if response.status_code == 304 and cached:
+                self.limiter.success()
+                return self.format_html(title, cached.text, redirects, pretty_print)
+            if response.status_code in (429, 503) or err_msg in response.text:
+                self.limiter.throttle(retry_after or 0)
+            elif response.status_code < 500:
+                self.limiter.success()
+                if self.cache and response.status_code == 200:
+                    self.cache.store(url, response.text,
+                                     response.headers.get("ETag"),
+                                     response.headers.get("Last-Modified"))
+                return self.format_html(title, response.text, redirects, pretty_print)
+            if attempt < self.retry.retries:
+                sleep(self.retry.delay(attempt, retry_after))
+        self.log(None, "w")
+        return None
+
+    def format_html(self, title: str, page: str, redirects: List[str], pretty_print: bool) -> str:
+        """Formats a Wikipedia article which has already
+        been fetched. Expects the name of the article and
+        its HTML and returns a string in Json format
+        containing all relevant data."""
+        self.title = title
+        return self.get_obj(StringIO(page), redirects, pretty_print)
+
+    def format_bytes(self, title: str, page: str, redirects: List[str]) -> Optional[bytearray]:
+        """Like format_html, but returns the Json as UTF-8 bytes
+        without making a str of it first."""
+        self.title = title
+        return self.get_bytes(StringIO(page), redirects)
 
     def get_norm_data(self) -> Optional[List[Dict[str, str]]]:
 
@@ -183,11 +313,14 @@ class Formatter:
             return self._get_norm_data_en()
 
     def _get_norm_data_de(self) -> Optional[List[Dict[str, str]]]:
-        norm_data_xpath = "//*[@id='normdaten']"
         try:
-            norm_data = str(html.tostring(self.tree.xpath(norm_data_xpath)[0]))
+            element = self._find(NORM_DATA_XPATH)
         except IndexError:
             return
+        return self._format_norm_data(element)
+
+    def _format_norm_data(self, element) -> Optional[List[Dict[str, str]]]:
+        norm_data = str(html.tostring(element))
         soup = BeautifulSoup(norm_data, 'html.parser')
         soup = self.clean_noprints(soup)
         a_tags = soup.find_all('a')
@@ -219,31 +352,43 @@ class Formatter:
 
     def get_heading(self):
 
-        heading_xpath = "//h1[@class='firstHeading']"
-        heading = str(html.tostring(self.tree.xpath(heading_xpath)[0]))
+        heading = str(html.tostring(self._find(HEADING_XPATH)))
         soup = BeautifulSoup(heading, 'html.parser')
         heading = soup.select('h1.firstHeading')[0].text.strip()
         return heading
 
     def get_categories(self):
-        categories_xpath = "//*[@id='mw-normal-catlinks']/ul"
         # get all list items in ul
         try:
-            categories = [li for li in self.tree.xpath(categories_xpath)[0]]
+            categories = [li for li in self._find(CATEGORIES_XPATH)]
         except IndexError as e:
             return None  # this happens if scraper is tryingn to scrape "User:xxx"
-        # transform all li in str format
-        categories = [str(html.tostring(cat)) for cat in categories]
         # transform all li in dict
-        categories = [self.format_categories(cat) for cat in categories]
+        categories = [self._get_category(cat) for cat in categories]
         return categories
 
+    def _get_category(self, li) -> Dict[str, str]:
+        return self.format_categories(str(html.tostring(li)))
+
+    def _find(self, xpath: str):
+        """Returns the first element matching the xpath
+        query or raises IndexError if there is none."""
+        return self.tree.xpath(xpath)[0]
+
+    def _get_element_text(self, element) -> Tuple[str, str]:
+        """Returns the raw text of a content element together
+        with its html."""
+        text_html = str(html.tostring(element))
+        return BeautifulSoup(text_html, 'html.parser').get_text(), text_html
+
+    def _get_element_links(self, text_html: str, text: str) -> Links:
+        return self.get_links(text_html, text)
+
     def get_paragraphs_headings(self):
 
-        content_xpath = "//div[@class='mw-parser-output']"
         content = ""
         try:
-            content = self.tree.xpath(content_xpath)[0]
+            content = self._find(CONTENT_XPATH)
         except IndexError as e:
             self.log(e, "w")
             # this is indicating to skip this file
@@ -253,6 +398,7 @@ class Formatter:
                     if self.filter_tags(element.tag)]
 
         paragraphs = []
+        self._strings = strings = dict()
 
         # Keeps track of which heading is up right now
         h = {
@@ -264,25 +410,23 @@ class Formatter:
             6: None
         }
 
-        # iterate over sections xpath query returned
-        for element in elements:
+        # Texts of all elements, the paragraphs are cleaned at once
+        texts = [self._get_element_text(element) for element in elements]
+        cleaned = iter(self.format_texts([text for element, (text, _) in zip(elements, texts)
+                                          if element.tag == "p" or element.tag == "ul"]))
 
-            text_html = str(html.tostring(element))
-            text = BeautifulSoup(text_html, 'html.parser').get_text()
+        # iterate over sections xpath query returned
+        for element, (text, text_html) in zip(elements, texts):
 
             # This is a paragraph
             if element.tag == "p" or element.tag == "ul":
 
-                text = self.format_text(text)
-                links = self.get_links(text_html, text)
+                text = next(cleaned)
+                links = self._get_element_links(text_html, text) if "links" in self.fields else None
                 is_list = element.tag == "u"
-                is_skippable = False
 
                 # Check if paragraph is a skippable paragraph
-                for i in range(2, 7):
-                    if h[i] is not None:
-                        if self.skip(h[i].text):
-                            is_skippable = True
+                is_skippable = any(h[i].is_skippable for i in range(2, 7) if h[i] is not None)
 
                 # Add paragraph if it has text (sometimes it doesnt)
                 if text:
@@ -296,7 +440,8 @@ class Formatter:
             for i in range(2, 7):
                 if element.tag == f"h{i}":
                     heading = self.format_heading(text)
-                    h[i] = Heading(heading)
+                    heading = strings.setdefault(heading, heading)
+                    h[i] = Heading(heading, self.skip(heading))
                     # reset all higher headings
                     for j in range(i, 7):
                         h[j+1] = None
@@ -324,9 +469,8 @@ class Formatter:
         return revision_id
 
     def get_article_id(self):
-        article_id_xpath = "//*[@id='t-wikibase']"
         try:
-            li = str(html.tostring(self.tree.xpath(article_id_xpath)[0]))
+            li = str(html.tostring(self._find(ARTICLE_ID_XPATH)))
         except IndexError as e:
             self.log(e, "a")
             return None
@@ -339,39 +483,94 @@ class Formatter:
 
     def get_obj(self, filestream: StringIO, redirects: List[str], pretty_print: bool):
 
+        content = self._content(filestream, redirects)
+        if content is None:
+            return None
+
+        with SERIALIZE_SECONDS.time():
+            return self._serialize(content, pretty_print)
+
+    def get_bytes(self, filestream: StringIO, redirects: List[str]) -> Optional[bytearray]:
+
+        content = self._content(filestream, redirects)
+        if content is None:
+            return None
+
+        with SERIALIZE_SECONDS.time():
+            return self.serializer.dumps(content)
 
+    def _content(self, filestream: StringIO, redirects: List[str]) -> Optional[LazyContent]:
 
         # Create etree object to query html
-        self.tree = etree.parse(filestream, etree.HTMLParser())
+        with PARSE_SECONDS.time():
+            self.tree = etree.parse(filestream, etree.HTMLParser())
+
+        with EXTRACT_SECONDS.time():
+            return self._extract(redirects)
 
+    def _has_content(self) -> bool:
+        try:
+            self._find(CONTENT_XPATH)
+        except IndexError as e:
+            self.log(e, "w")
+            return False
+        return True
+
+    def _has_categories(self) -> bool:
+        try:
+            return len(self._find(CATEGORIES_XPATH)) > 0
+        except IndexError:
+            return False
+
+    def _extract(self, redirects: List[str]) -> Optional[LazyContent]:
+        """Checks if the page is to be skipped and returns the
+        selected fields, to be computed once they are accessed."""
+
+        fields = self.fields
         # h1 recursively contains all headings
-        content = dict()
-        paragraphs, h1 = self.get_paragraphs_headings()
-        if not paragraphs and not h1:
-            return None  # there are some files that need to skipped
-        content["headings"] = Heading.to_dict(h1)
-        content["paragraphs"] = self.paragraphs_to_dict(paragraphs)
-        categories = self.get_categories()
-        if not categories:
+        paragraphs, h1 = None, None
+        if "headings" in fields or "paragraphs" in fields:
+            paragraphs, h1 = self.get_paragraphs_headings()
+            if not paragraphs and not h1:
+                SKIPS.inc(reason="no_content")
+                return None  # there are some files that need to skipped
+        elif not self._has_content():
+            SKIPS.inc(reason="no_content")
+            return None
+        categories = None
+        if "categories" in fields:
+            categories = self.get_categories()
+        if not (categories if "categories" in fields else self._has_categories()):
+            SKIPS.inc(reason="no_categories")
             return None
-        content["categories"] = categories
-        content["revision_id"] = self.get_revision_id()
-        content["article_id"] = self.get_article_id()
-        content["norm_data"] = self.get_norm_data()
-        content["redirects"] = [h1.text.replace(" ", "_")] + redirects
-        content["raw_html"] = str(html.tostring(self.tree))
-
-        if pretty_print:
-            jsonarray = json.dumps(content,
-                                   ensure_ascii=False,
-                                   indent=4,
-                                   separators=(',', ': '))
-        else:
-            jsonarray = json.dumps(content,
-                                   ensure_ascii=False,
-                                   separators=(',', ': '))
+
+        # headings and paragraphs stay objects, see serialize.py
+        getters = {"headings": lambda: h1,
+                   "paragraphs": lambda: paragraphs,
+                   "categories": lambda: categories,
+                   "revision_id": self.get_revision_id,
+                   "article_id": self.get_article_id,
+                   "norm_data": self.get_norm_data,
+                   "redirects": lambda: [(h1.text if h1 else self.get_heading()).replace(" ", "_")] + redirects,
+                   "raw_html": lambda: str(html.tostring(self.tree))}
+        # links are written with the paragraphs they belong to
+        return LazyContent({field: getters[field] for field in fields if field != "links"})
+
+    def _serialize(self, content: Mapping, pretty_print: bool) -> str:
+        if not pretty_print:
+            return self.serializer.dumps(content).decode("utf-8")
+        # json only takes dicts, this computes the fields
+        content = {field: Heading.to_dict(value) if isinstance(value, Heading)
+                   else self.paragraphs_to_dict(value) if field == "paragraphs" else value
+                   for field, value in content.items()}
+        jsonarray = json.dumps(content,
+                               ensure_ascii=False,
+                               indent=4,
+                               separators=(',', ': '))
         return jsonarray
 
-#
-f = Formatter()
-f.format_with_title("Angeela Merkel", [], False)
\ No newline at end of file
+
+if __name__ == "__main__":
+    with open("config.json", "r") as file:
+        f = Formatter.from_config("de", json.loads(str(file.read()))["fetch"])
+    f.format_with_title("Angeela Merkel", [], False)
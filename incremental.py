@@ -0,0 +1,171 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Incremental re-scrape after a new dump.
+
+Compares what the last scrape stored with the title index built
+from a new dump by redirect.py: a page is queued again if it is
+new, if its page_latest differs from the revision id it was
+stored with, or if its redirects changed. The queued pages are
+written as a title index of their own and taken out of the
+journal, so a scrape over that index fetches only them:
+
+    python redirect.py
+    python incremental.py ../Dumps/main_to_redirect.idx ../Dumps/changed.idx
+
+and point titles_path to the new index. Once that scrape is
+done,
+
+    python incremental.py --verify ../Dumps/changed.idx
+
+checks that every queued page reads back at the revision the
+index holds for it, not as the copy stored before. Pages the
+formatter skipped last time are left out, as nothing tells
+whether they changed. With the sqlite scheduler backend, delete its database
+before the next run, as it holds the batches of the old index.
+
+Both need revision_id among the "fields" of config.json; without
+it every stored page would look changed.
+"""
+
+import argparse
+import json
+import re
+import sys
+from collections import Counter
+from typing import Dict, List, Tuple
+from format import Formatter
+from journal import Journal
+from reader import ScrapeReader
+from title_index import TitleIndex, write_index
+
+# the first revision_id key, which comes before raw_html
+REVISION_ID = re.compile(rb'"revision_id":\s*"(\d*)"')
+
+
+class Incremental:
+
+    def __init__(self, index_path: str):
+
+        self._config = self._load_config()
+        self._index_path = index_path
+        self.counts = Counter()
+
+    @staticmethod
+    def _load_config():
+        with open("config.json", "r") as file:
+            return json.loads(str(file.read()))
+
+    def _check_fields(self):
+        """Stored pages without a revision id would all parse as
+        revision 0, and the whole store would be scraped again."""
+        if "revision_id" not in Formatter.select_fields(self._config["fields"]):
+            raise Exception("Incremental re-scrapes need revision_id among the fields in config.json.")
+
+    def stored_revisions(self, reader: ScrapeReader) -> Dict[str, int]:
+        """Maps every stored title to the revision id it was scraped
+        at, 0 where the page had none."""
+        revisions = dict()
+        for title, match_obj in reader.search(REVISION_ID):
+            revisions[title] = int(match_obj.group(1) or 0) if match_obj else 0
+        return revisions
+
+    def plan(self) -> Tuple[Dict[str, List[str]], Dict[str, Tuple[int, int]]]:
+        """Returns the title -> redirects mapping and the (page_len,
+        page_latest) of the pages to scrape again."""
+        self._check_fields()
+        reader = ScrapeReader(self._config["save_path"])
+        journal = Journal(self._config["state_path"] + "journal.sqlite", **self._config["journal"])
+        index = TitleIndex(self._index_path)
+        try:
+            stored = self.stored_revisions(reader)
+            lengths, latest = index.lengths(), index.revisions()
+            mapping, pages = dict(), dict()
+            for number in range(len(index)):
+                title, redirects = index[number]
+                if title in stored:
+                    revision = stored.pop(title)
+                    if latest[number] and latest[number] != revision:
+                        reason = "changed"
+                    elif set(redirects) != set(reader.redirects(title)):
+                        reason = "redirects_changed"
+                    else:
+                        reason = "unchanged"
+                elif title in journal:
+                    reason = "skipped_before"
+                else:
+                    reason = "new"
+                self.counts[reason] += 1
+                if reason in ("changed", "redirects_changed", "new"):
+                    mapping[title] = redirects
+                    pages[title] = (lengths[number], latest[number])
+            # stored pages which are no longer in the dump
+            self.counts["gone"] = len(stored)
+        finally:
+            index.close()
+            journal.close()
+            reader.close()
+        return mapping, pages
+
+    def verify(self) -> Counter:
+        """Counts the pages of the index by whether the store returns
+        them at the revision the index holds for them ("current"),
+        at another one ("stale") or not at all ("missing")."""
+        self._check_fields()
+        reader = ScrapeReader(self._config["save_path"])
+        index = TitleIndex(self._index_path)
+        results = Counter()
+        try:
+            latest = index.revisions()
+            for number in range(len(index)):
+                title, _ = index[number]
+                content = reader.get(title)
+                if content is None:
+                    results["missing"] += 1
+                    continue
+                match_obj = REVISION_ID.search(content.encode("utf-8"))
+                revision = int(match_obj.group(1) or 0) if match_obj else 0
+                # pages without a page_latest in the dump can only be missing
+                results["current" if revision == latest[number] or not latest[number] else "stale"] += 1
+        finally:
+            index.close()
+            reader.close()
+        return results
+
+    def save(self, path: str) -> int:
+        """Writes the pages to scrape again as title index and takes
+        them out of the journal. Returns how many there are."""
+        mapping, pages = self.plan()
+        write_index(path, mapping, pages)
+        journal = Journal(self._config["state_path"] + "journal.sqlite", **self._config["journal"])
+        try:
+            journal.remove(mapping)
+        finally:
+            journal.close()
+        return len(mapping)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Queues the pages which changed since the last scrape.")
+    parser.add_argument("index", help="title index built from the new dump")
+    parser.add_argument("output", nargs="?", help="where to write the title index of the changed pages")
+    parser.add_argument("--verify", action="store_true",
+                        help="check that the pages of a re-scraped index read back at its revisions")
+    args = parser.parse_args()
+    incremental = Incremental(args.index)
+    if args.verify:
+        results = incremental.verify()
+        for result, count in results.most_common():
+            print(f"{count:>10}  {result}")
+        sys.exit(1 if results["stale"] or results["missing"] else 0)
+    if args.output is None:
+        parser.error("the output path is required unless --verify is given")
+    queued = incremental.save(args.output)
+    for reason, count in incremental.counts.most_common():
+        print(f"{count:>10}  {reason}")
+    print(f"{queued} pages queued in {args.output}.")
@@ -0,0 +1,232 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Formats articles from Wikimedia Enterprise HTML dumps
+(tar.gz archives of NDJSON files, one article per line)
+instead of requesting them one by one.
+
+The archive is streamed record by record. Every article's
+Parsoid HTML is wrapped into the same landmarks the web page
+has (heading, content, categories, revision id, Wikidata item)
+so the Formatter reads it unchanged, and formatting is spread
+over a pool of spawned processes, as forking after the stats and
+log threads started could leave one of their locks held in a
+worker. Redirects are joined in from the title index, finished
+titles are kept in the journal the Scraper uses and articles go
+to the same segment store.
+
+Usage: python ingest.py <dump.tar.gz> [language]
+"""
+
+import json
+import os
+import sys
+import tarfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from html import escape
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import unquote
+from lxml import html
+from format import Formatter
+from journal import Journal
+from logger import setup_logging
+from metrics import REGISTRY, start_stats
+from single_pass import SinglePassFormatter
+from store import SegmentWriter
+from title_index import TitleIndex
+
+CATEGORY_REL = "mw:PageProp/Category"
+
+ARTICLES = REGISTRY.counter("wiki_scraper_articles_total", "Titles finished, by result", ["result"])
+
+_formatter = None
+_titles = None
+_journal = None
+
+
+def _init_worker(language: str, single_pass: bool, titles_path: str, journal_path: str,
+                 metrics: Optional[Dict] = None, logging: Optional[Dict] = None,
+                 fields: Optional[List[str]] = None, serializer: str = "json"):
+    global _formatter, _titles, _journal
+    if single_pass:
+        _formatter = SinglePassFormatter(language, fields, serializer)
+    else:
+        _formatter = Formatter(language, fields, serializer)
+    _titles = TitleIndex(titles_path)
+    _journal = Journal(journal_path)
+    start_stats(metrics, "formatter")
+    setup_logging(logging, "formatter")
+
+
+def _category(href: str) -> str:
+    """Turns the href of a Parsoid category link into the list
+    item the web page shows for it."""
+    href = "/wiki/" + href[2:].split("#", 1)[0]
+    title = unquote(href[6:]).replace("_", " ")
+    name = title.split(":", 1)[-1]
+    return f"<li><a href=\"{escape(href)}\" title=\"{escape(title)}\">{escape(name, quote=False)}</a></li>"
+
+
+def build_page(record: Dict) -> str:
+    """Wraps the Parsoid HTML of a dump record into the markup
+    of the rendered web page which the Formatter looks for."""
+    body = html.document_fromstring(record["article_body"]["html"]).find("body")
+    categories = []
+    for link in list(body.iter("link")):
+        if link.get("rel") == CATEGORY_REL:
+            categories.append(_category(link.get("href", "./")))
+            link.drop_tree()
+    for section in list(body.iter("section")):
+        section.drop_tag()
+    for a in body.iter("a"):
+        href = a.get("href")
+        if href and href.startswith("./"):
+            a.set("href", "/wiki/" + href[2:])
+    # the web page puts every block on a line of its own
+    for element in body:
+        element.tail = "\n"
+    content = "".join(html.tostring(element, encoding="unicode") for element in body)
+    page = [f"<html><head><title>{escape(record['name'])}</title></head><body>",
+            f"<h1 id=\"firstHeading\" class=\"firstHeading\">{escape(record['name'])}</h1>",
+            f"<div id=\"mw-content-text\"><div class=\"mw-parser-output\">{content}</div></div>",
+            "<div id=\"catlinks\" class=\"catlinks\"><div id=\"mw-normal-catlinks\" class=\"mw-normal-catlinks\">"
+            f"<ul>{''.join(categories)}</ul></div></div>"]
+    entity = record.get("main_entity")
+    if entity:
+        page.append("<ul><li id=\"t-wikibase\"><a href=\"https://www.wikidata.org/wiki/Special:EntityPage/"
+                    f"{escape(entity['identifier'])}\">Wikidata</a></li></ul>")
+    page.append(f"<!-- Read from an HTML dump with page id {record.get('identifier')} "
+                f"and revision id {record['version']['identifier']} -->")
+    page.append("</body></html>")
+    return "\n".join(page)
+
+
+def _redirects(title: str, record: Dict) -> List[str]:
+    """Redirects of the title index, or those of the record
+    if the title is not in the index."""
+    index = _titles.find(title)
+    if index is not None:
+        return _titles[index][1]
+    return [redirect["name"].replace(" ", "_") for redirect in record.get("redirects", [])]
+
+
+def _ingest(lines: List[bytes]) -> List[Tuple[str, List[str], Optional[bytearray]]]:
+    """Formats a batch of dump lines in a worker process. Pages
+    which are no articles or finished already are left out, a
+    page the formatter fails on is logged and has content None."""
+    results = []
+    for line in lines:
+        try:
+            record = json.loads(line)
+            if record["namespace"]["identifier"] != 0 or "html" not in record.get("article_body", {}):
+                continue
+            title = record["name"].replace(" ", "_")
+            if title in _journal:
+                continue
+            redirects = _redirects(title, record)
+        except (ValueError, KeyError, TypeError):
+            continue
+        try:
+            content = _formatter.format_bytes(title, build_page(record), redirects)
+        except Exception as e:
+            _formatter.title = title
+            _formatter.log(e, "w")
+            content = None
+        results.append((title, redirects, content))
+    return results
+
+
+def iter_lines(path: str) -> Iterator[bytes]:
+    """Streams the lines of all files in a dump archive without
+    unpacking it."""
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            with archive.extractfile(member) as file:
+                for line in file:
+                    if line.strip():
+                        yield line
+
+
+class Ingester:
+
+    def __init__(self, language: str = "de"):
+
+        self._config = self._load_config()
+        self._language = language
+        self._journal_path = self._config["state_path"] + "journal.sqlite"
+
+    @staticmethod
+    def _load_config():
+        with open("config.json", "r") as file:
+            return json.loads(str(file.read()))
+
+    def _batches(self, path: str) -> Iterator[List[bytes]]:
+        batch = []
+        for line in iter_lines(path):
+            batch.append(line)
+            if len(batch) >= self._config["ingest"]["batch_size"]:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def ingest(self, path: str):
+        """Formats all articles of a dump and saves them. At most
+        a few batches per worker are read ahead of the formatting."""
+        self._store = SegmentWriter(self._config["save_path"], "content_ingest",
+                                    **self._config["store"])
+        self._journal = Journal(self._journal_path, **self._config["journal"])
+        self._unflushed = []
+        initargs = (self._language, self._config["single_pass"],
+                    self._config["titles_path"], self._journal_path, self._config["metrics"], self._config["logging"],
+                    Formatter.select_fields(self._config["fields"]), self._config["serializer"])
+        stats = start_stats(self._config["metrics"], "ingest")
+        logs = setup_logging(self._config["logging"], "ingest")
+        workers = self._config["ingest"]["workers"] or os.cpu_count()
+        try:
+            with ProcessPoolExecutor(workers, mp_context=get_context("spawn"),
+                                     initializer=_init_worker, initargs=initargs) as pool:
+                window = workers * 4
+                in_flight = set()
+                for batch in self._batches(path):
+                    if len(in_flight) >= window:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._write(future.result())
+                    in_flight.add(pool.submit(_ingest, batch))
+                for future in wait(in_flight).done:
+                    self._write(future.result())
+        finally:
+            self._store.close()
+            self._journal.add(self._unflushed)
+            self._journal.close()
+            if stats:
+                stats.stop()
+            if logs:
+                logs.stop()
+
+    def _write(self, results: List[Tuple[str, List[str], Optional[bytearray]]]):
+        """Saves a formatted batch. Titles go to the journal once
+        the store has flushed them."""
+        for title, redirects, content in results:
+            flushed = False
+            if content:
+                flushed = self._store.write(title, redirects, content)
+            ARTICLES.inc(result="written" if content else "skipped")
+            self._unflushed.append(title)
+            if flushed:
+                self._journal.add(self._unflushed)
+                self._unflushed = []
+
+
+if __name__ == "__main__":
+    ingester = Ingester(sys.argv[2] if len(sys.argv) > 2 else "de")
+    ingester.ingest(sys.argv[1])
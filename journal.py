@@ -0,0 +1,85 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Completion journal of a scrape.
+
+Every finished title is recorded in an SQLite database which
+all scripts share, so a restart skips finished titles with one
+indexed lookup each, no matter how the titles were split between
+scripts before. Titles are committed in batches, each commit
+being one fsync.
+
+The database keeps the rollback journal, as WAL does not work
+on network filesystems, and the scripts of several machines may
+share it.
+"""
+
+import os
+import sqlite3
+import time
+from threading import Lock
+from typing import Iterable
+
+
+class Journal:
+
+    def __init__(self, path: str, batch_size: int = 1000, interval: float = 5):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._batch_size = batch_size
+        self._interval = interval
+        self._lock = Lock()
+        self._pending = set()
+        self._last_commit = time.monotonic()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # also turns a journal written in WAL mode before back to the rollback journal
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS done (title TEXT PRIMARY KEY) WITHOUT ROWID")
+        self._db.commit()
+
+    def __contains__(self, title: str) -> bool:
+        with self._lock:
+            if title in self._pending:
+                return True
+            return self._db.execute("SELECT 1 FROM done WHERE title = ?", (title,)).fetchone() is not None
+
+    def add(self, titles: Iterable[str]):
+        """Marks titles as finished. They are committed once
+        batch_size titles are pending or interval seconds passed."""
+        with self._lock:
+            self._pending.update(titles)
+            if (len(self._pending) >= self._batch_size
+                    or time.monotonic() - self._last_commit >= self._interval):
+                self._commit()
+
+    def remove(self, titles: Iterable[str]):
+        """Marks titles as not finished, so the next run scrapes
+        them again."""
+        with self._lock:
+            self._commit()
+            self._db.executemany("DELETE FROM done WHERE title = ?", ((title,) for title in titles))
+            self._db.commit()
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if self._pending:
+            self._db.executemany("INSERT OR IGNORE INTO done VALUES (?)",
+                                 ((title,) for title in self._pending))
+            self._db.commit()
+            self._pending = set()
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -0,0 +1,159 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Structured logging of skipped files, paragraphs and article ids.
+
+Log calls only put a record on a queue. A background thread
+takes the records off the queue and writes them as Json lines
+to <path>/<name>-<pid>.jsonl, flushing in batches and rotating
+the file when it gets too big. Every process writes its own
+file, so scripts and formatter workers never contend for one.
+Run this module to count the logged reasons of all files:
+
+    python logger.py
+"""
+
+import json
+import logging
+import os
+import queue
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing.util import Finalize
+from typing import Dict, Optional
+
+LOGGER = logging.getLogger("wiki")
+SUFFIX = ".jsonl"
+
+
+class JsonLineFormatter(logging.Formatter):
+
+    def __init__(self, worker: str):
+
+        super().__init__()
+        self._worker = worker
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                "level": record.levelname,
+                "worker": self._worker,
+                "title": getattr(record, "title", None),
+                "reason": getattr(record, "reason", None),
+                "error": getattr(record, "error", None),
+                "message": record.getMessage()}
+        return json.dumps(line, ensure_ascii=False)
+
+
+class BatchingFileHandler(RotatingFileHandler):
+    """Writes every record but flushes only every batch_size
+    records or interval seconds, and when closed."""
+
+    def __init__(self, path: str, max_bytes: int, backup_count: int, batch_size: int, interval: float):
+
+        super().__init__(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self._batch_size = batch_size
+        self._interval = interval
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        self._pending += 1
+        if self._pending >= self._batch_size or time.monotonic() - self._last_flush >= self._interval:
+            self._flush()
+
+    def _flush(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.flush()
+        finally:
+            self.release()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self._flush()
+        super().close()
+
+
+class _Prepared(QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Only merges the message and its arguments. The Json is
+        built by the writer thread, not by the caller."""
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+
+class LogWriter:
+
+    def __init__(self, handler: logging.Handler, records: queue.SimpleQueue):
+
+        self._handler = handler
+        self._listener = QueueListener(records, handler)
+        self._listener.start()
+        self._stopped = False
+
+    def stop(self):
+        """Writes the records still queued and closes the file."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._listener.stop()
+        self._handler.close()
+
+
+def setup_logging(config: Optional[Dict], name: str) -> Optional[LogWriter]:
+    """Sends the records of the "wiki" logger of this process to
+    its own log file, as configured in the "logging" section of
+    config.json. Like the stats, the queue is drained once more
+    by a multiprocessing finalizer when a pool worker exits."""
+    if not config:
+        return None
+    os.makedirs(config["path"], exist_ok=True)
+    handler = BatchingFileHandler(os.path.join(config["path"], f"{name}-{os.getpid()}{SUFFIX}"),
+                                  config["max_bytes"], config["backup_count"],
+                                  config["batch_size"], config["interval"])
+    handler.setFormatter(JsonLineFormatter(f"{name}-{os.getpid()}"))
+    records = queue.SimpleQueue()
+    for old in list(LOGGER.handlers):
+        LOGGER.removeHandler(old)
+    LOGGER.addHandler(_Prepared(records))
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.propagate = False
+    writer = LogWriter(handler, records)
+    Finalize(writer, writer.stop, exitpriority=10)
+    return writer
+
+
+def summary(path: str) -> Counter:
+    """Counts the logged reasons in all log files, rotated ones
+    included."""
+    reasons = Counter()
+    for name in os.listdir(path):
+        if SUFFIX not in name:
+            continue
+        with open(os.path.join(path, name), "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    reasons[json.loads(line)["reason"]] += 1
+                except (ValueError, KeyError):
+                    continue
+    return reasons
+
+
+if __name__ == "__main__":
+    with open("config.json", "r") as file:
+        config = json.loads(str(file.read()))["logging"]
+    for reason, count in summary(config["path"]).most_common():
+        print(f"{count:>10}  {reason}")
@@ -7,24 +7,24 @@ Text Technology Lab
 September 2019
 
 Utility to speed up wikipedia scraping.
-NOTE: Only tested on MacOS.
-
-Expects two arguments.
-1) Number of scripts: "number" indicating with how many terminal
-   windows you want to run the script.
-   For example: python main.py 10
-2) Safe mode: argument you can set if you want to set safe mode.
-   Safe mode cancels script in every window and restarts it.
-   This assures to restart if wikipedia blocked your calls.
-   For example: python main.py 10 -s
+
+Accepts three arguments.
+1) Number of scripts: how many worker processes to run.
+   For example: python main.py -a 10
+2) Safe mode: minutes after which a worker which did not finish
+   a single title is restarted. Only that worker is restarted,
+   the others keep running.
+   For example: python main.py -a 10 -s 15
+3) Language: python main.py -a 10 -l en
+
+Ctrl-C or python close.py stops the workers after they wrote
+the pages they already fetched.
 """
 
 import sys
-import os
-import time
-import datetime
 from typing import Union
 import json
+from supervisor import Supervisor
 
 
 class Main:
@@ -44,10 +44,6 @@ class Main:
         safe_arg = self._get_arg("-s")
         self._safe_mode_time = safe_arg
 
-        self._start_command = self._get_command("start")
-        self._stop_command = self._get_command("stop")
-        self._restart_command = self._get_command("restart")
-
         self._run()
 
     @staticmethod
@@ -65,9 +61,9 @@ class Main:
               "\n"
               "You can specify the following arguments:\n"
               "-s <integer> (starts safe mode)\n"
-              "Specifies how long to wait until you want to restart the script.\n"
+              "Specifies after how many minutes without progress a script is restarted.\n"
               "This makes sure you can restart the scripts in case of server time outs.\n"
-              "Default: no safe mode at all.\n"
+              "Default: the stall_timeout in ./config.json.\n"
               "\n"
               "-a <integer> (amount of scripts to run)\n"
               "Specifies how many scripts you want to run at the same time.\n"
@@ -116,24 +112,9 @@ class Main:
                                         f"{str(languages)[1:-1]}.")
 
     def _run(self):
-        if self._safe_mode_time:
-            os.system(self._start_command)
-            counter = 1
-            while True:
-                time.sleep(self._safe_mode_time * 60)  # wait 12 minutes and restart script
-                counter += 1
-                os.system(self._restart_command)
-                print(f"Round {counter}: " + str(datetime.datetime.now()).split(".")[0])
-        else:
-            os.system(self._start_command)
-
-    def _get_command(self, name: str) -> str:
-        path = self._config["commands_path"] + f"{name}_command.txt"
-        with open(path, "r+") as file:
-            command = file.read()
-            command = command.replace("no_of_scripts", str(self._no_of_scripts))
-            command = command.replace("language", str(self._language))
-            return command
-
-
-m = Main()
+        stall_timeout = self._safe_mode_time * 60 if self._safe_mode_time else None
+        Supervisor(self._language, self._no_of_scripts, stall_timeout).run()
+
+
+if __name__ == "__main__":
+    m = Main()
@@ -0,0 +1,274 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+In-process metrics of a scrape.
+
+Every module registers its counters and latency histograms in
+the REGISTRY of its process. A StatsWriter writes the registry
+of a process to <path>/<name>-<pid>.json every few seconds, and
+aggregate() adds up the files of all scripts and formatter
+workers. Run this module to serve the sum as Prometheus text:
+
+    python metrics.py [--port 9108]     serves /metrics
+    python metrics.py --once            prints the sum as Json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.util import Finalize
+from threading import Event, Lock, Thread
+from typing import Dict, Iterator, Optional, Sequence
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = defaultdict(float)
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            values = [[list(key), value] for key, value in self._values.items()]
+        return {"type": "counter", "help": self.help, "labels": list(self.labels), "values": values}
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # one more for the values above the last bucket
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"type": "histogram", "help": self.help, "buckets": list(self.buckets),
+                    "counts": list(self._counts), "sum": self._sum}
+
+
+class Registry:
+
+    def __init__(self):
+
+        self._metrics = dict()
+        self._lock = Lock()
+
+    def _get(self, cls, name: str, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            metric = self._metrics[name]
+        if not isinstance(metric, cls):
+            raise Exception(f"Metric {name} is already registered as {type(metric).__name__}.")
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def reset(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+class StatsWriter(Thread):
+
+    def __init__(self, path: str, name: str, interval: float = 5, registry: Registry = REGISTRY):
+
+        super().__init__(daemon=True)
+        os.makedirs(path, exist_ok=True)
+        self._file = os.path.join(path, f"{name}-{os.getpid()}.json")
+        self._name = name
+        self._interval = interval
+        self._registry = registry
+        self._stopped = Event()
+        self._closed = False
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.flush()
+
+    def flush(self):
+        stats = {"worker": self._name, "pid": os.getpid(), "updated": time.time(),
+                 "metrics": self._registry.snapshot()}
+        temporary = self._file + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(stats, file)
+        os.replace(temporary, self._file)
+
+    def stop(self):
+        """Writes the stats one last time. Only the first call does,
+        the finalizer of start_stats calls it again at exit."""
+        if self._closed:
+            return
+        self._closed = True
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+
+
+def start_stats(config: Optional[Dict], name: str) -> Optional[StatsWriter]:
+    """Starts writing the stats of this process as configured in
+    the "metrics" section of config.json. Processes of a pool are
+    left without running their exit handlers, so the last stats
+    are written by a multiprocessing finalizer as well. A forked
+    worker starts from zero instead of the counts of its parent."""
+    if not config:
+        return None
+    REGISTRY.reset()
+    writer = StatsWriter(config["path"], name, config["interval"])
+    writer.start()
+    Finalize(writer, writer.stop, exitpriority=10)
+    return writer
+
+
+def aggregate(path: str) -> Dict[str, Dict]:
+    """Adds up the stats files of all processes."""
+    total = dict()
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(path, name), "r", encoding="utf-8") as file:
+                metrics = json.load(file)["metrics"]
+        except (OSError, ValueError, KeyError):
+            continue
+        for metric_name, metric in metrics.items():
+            if metric_name not in total:
+                total[metric_name] = json.loads(json.dumps(metric))
+                continue
+            merged = total[metric_name]
+            if metric["type"] == "counter":
+                values = {tuple(key): value for key, value in merged["values"]}
+                for key, value in metric["values"]:
+                    values[tuple(key)] = values.get(tuple(key), 0) + value
+                merged["values"] = [[list(key), value] for key, value in values.items()]
+            elif merged["buckets"] == metric["buckets"]:
+                merged["counts"] = [a + b for a, b in zip(merged["counts"], metric["counts"])]
+                merged["sum"] += metric["sum"]
+    return total
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def to_prometheus(metrics: Dict[str, Dict]) -> str:
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        if metric["type"] == "counter":
+            for key, value in metric["values"]:
+                labels = ",".join(f"{label}=\"{_escape(part)}\"" for label, part in zip(metric["labels"], key))
+                lines.append(f"{name}{{{labels}}} {_number(value)}" if labels else f"{name} {_number(value)}")
+            continue
+        cumulative = 0
+        for bound, count in zip(metric["buckets"] + ["+Inf"], metric["counts"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{{le=\"{bound}\"}} {cumulative}")
+        lines.append(f"{name}_sum {_number(metric['sum'])}")
+        lines.append(f"{name}_count {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def serve(path: str, port: int):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = to_prometheus(aggregate(path)).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer(("", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    with open("config.json", "r") as file:
+        config = json.loads(str(file.read()))["metrics"]
+    parser = argparse.ArgumentParser(description="Serves the metrics of all scraper processes.")
+    parser.add_argument("--port", type=int, default=config["port"])
+    parser.add_argument("--once", action="store_true", help="print the aggregated stats and exit")
+    args = parser.parse_args()
+    if args.once:
+        json.dump(aggregate(config["path"]), sys.stdout, indent=2)
+    else:
+        serve(config["path"], args.port)
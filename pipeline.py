@@ -0,0 +1,159 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Staged fetch -> format -> write pipeline.
+
+Pages are fetched on the event loop, formatted in a pool of
+worker processes and handed to a single writer. Every stage
+holds at most queue_size pages, so a slow stage makes the ones
+before it wait instead of piling up pages in memory.
+
+The pool lives as long as the Pipeline and is shut down by
+close(). Its workers are spawned, not forked: the process
+already runs the threads of its stats and its log, and a fork
+while one of them holds a lock would leave the lock held forever
+in the worker.
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from fetch import Fetcher, iterate
+from format import Formatter
+from logger import LOGGER, setup_logging
+from metrics import REGISTRY, start_stats
+from serialize import Serializer
+from single_pass import SinglePassFormatter
+
+FORMAT_SECONDS = REGISTRY.histogram("wiki_format_seconds", "Time to format a page in a worker")
+ERRORS = REGISTRY.counter("wiki_format_errors_total", "Pages the formatter failed on, by exception", ["reason"])
+
+_formatter = None
+
+
+def _init_worker(language: str, single_pass: bool, metrics: Optional[Dict] = None,
+                 logging: Optional[Dict] = None, fields: Optional[List[str]] = None,
+                 serializer: str = "json"):
+    global _formatter
+    if single_pass:
+        _formatter = SinglePassFormatter(language, fields, serializer)
+    else:
+        _formatter = Formatter(language, fields, serializer)
+    start_stats(metrics, "formatter")
+    setup_logging(logging, "formatter")
+
+
+def _format(title: str, page: str, redirects: List[str]) -> Optional[bytearray]:
+    """Formats one page in a worker process into Json bytes. A
+    page the formatter fails on is logged and skipped."""
+    try:
+        with FORMAT_SECONDS.time():
+            return _formatter.format_bytes(title, page, redirects)
+    except Exception as e:
+        ERRORS.inc(reason=type(e).__name__)
+        _formatter.log(e, "w")
+        return None
+
+
+class Pipeline:
+
+    def __init__(self,
+                 fetcher: Fetcher,
+                 language: str = "de",
+                 single_pass: bool = True,
+                 workers: int = None,
+                 queue_size: int = 64,
+                 metrics: Dict = None,
+                 logging: Dict = None,
+                 fields: List[str] = None,
+                 serializer: str = "json"
+                 ):
+
+        self._fetcher = fetcher
+        self._queue_size = queue_size
+        # fails here rather than in every worker
+        fields = Formatter.select_fields(fields)
+        Serializer(serializer)
+        self._pool = ProcessPoolExecutor(workers, mp_context=get_context("spawn"), initializer=_init_worker,
+                                         initargs=(language, single_pass, metrics, logging, fields, serializer))
+        self._error = None
+
+    async def run(self, items: Union[Iterable[Tuple[str, List[str], Any]], AsyncIterable[Tuple[str, List[str], Any]]],
+                  write: Callable[[str, Any, Optional[bytearray]], None],
+                  dropped: Optional[Callable[[str, Any], None]] = None):
+        """Fetches, formats and writes (title, redirects, key) items.
+        write(title, key, content) is called from one thread at a
+        time with the Json as bytes, or None for pages the formatter
+        skipped. items may be asynchronous, e.g. wait for the next
+        batch of work while the pages before it are still running.
+        Titles whose request failed are not written, but passed to
+        dropped(title, key) on the event loop if it is given."""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self._queue_size)
+        written = asyncio.Queue(self._queue_size)
+        pending = self._pending(items)
+        self._error = None
+        writer = asyncio.ensure_future(self._write(written, write))
+        formatting = set()
+        try:
+            async for title, (redirects, key), page in self._fetcher.fetch_all(pending):
+                if self._error:
+                    break
+                await slots.acquire()
+                task = asyncio.ensure_future(
+                    self._format(loop, self._pool, slots, written, dropped, title, redirects, key, page))
+                formatting.add(task)
+                task.add_done_callback(formatting.discard)
+            await asyncio.gather(*formatting)
+            await written.put(None)
+            await writer
+        finally:
+            for task in list(formatting):
+                task.cancel()
+            writer.cancel()
+        if self._error:
+            raise self._error
+
+    def close(self):
+        """Shuts the formatter processes down. Blocks until they
+        have exited."""
+        self._pool.shutdown(cancel_futures=True)
+
+    @staticmethod
+    async def _pending(items) -> AsyncIterator[Tuple[str, Tuple[List[str], Any]]]:
+        async for title, redirects, key in iterate(items):
+            yield title, (redirects, key)
+
+    @staticmethod
+    async def _format(loop, pool, slots, written, dropped, title, redirects, key, page):
+        try:
+            if page is None:
+                # the request failed, the title is not written and fetched again later
+                LOGGER.warning("Could not fetch %s.", title, extra={"title": title, "reason": "fetch_failed"})
+                if dropped:
+                    dropped(title, key)
+                return
+            content = await loop.run_in_executor(pool, _format, title, page, redirects)
+            await written.put((title, key, content))
+        finally:
+            slots.release()
+
+    async def _write(self, written: asyncio.Queue, write):
+        """Hands the formatted pages to write. After write has
+        failed the queue is still drained so no stage blocks."""
+        while True:
+            item = await written.get()
+            if item is None:
+                return
+            if self._error:
+                continue
+            try:
+                await asyncio.to_thread(write, *item)
+            except Exception as e:
+                self._error = e
@@ -0,0 +1,137 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Rate limiting and retries for requests to Wikipedia.
+
+RateLimiter is a token bucket shared by all requests of a
+process. Its rate grows additively while requests succeed and
+is cut multiplicatively when the servers answer 429, 503 or
+with the maintenance page (AIMD), so it settles at the highest
+rate the servers tolerate. RetryPolicy decides how long to wait
+before a failed request is repeated.
+
+The limits in config.json hold for all scripts of a machine
+together, each Scraper gets its share of them (see
+Fetcher.from_config).
+"""
+
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from typing import Optional
+
+
+class RateLimiter:
+
+    def __init__(self,
+                 rate: float = 50,
+                 min_rate: float = 1,
+                 max_rate: float = 500,
+                 increase: float = 1,
+                 decrease: float = 0.5,
+                 cooldown: float = 1
+                 ):
+
+        self._rate = rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._cooldown = cooldown
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def _take(self) -> float:
+        """Takes a token if there is one. Otherwise returns how
+        long to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            # at most one second worth of requests can pile up
+            self._tokens = min(max(self._rate, 1), self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self._rate
+
+    async def acquire(self):
+        delay = self._take()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._take()
+
+    def acquire_blocking(self):
+        delay = self._take()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self._take()
+
+    def success(self):
+        """Additive increase: grows the rate by `increase`
+        requests per second for every second of successes."""
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._increase / self._rate)
+
+    def throttle(self, pause: float = 0):
+        """Multiplicative decrease. Responses to requests which were
+        sent at the old rate arrive together, so the rate is cut at
+        most once per cooldown. pause stops all requests for that
+        many seconds, e.g. as demanded by a Retry-After header."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease >= self._cooldown:
+                self._rate = max(self._min_rate, self._rate * self._decrease)
+                self._last_decrease = now
+                self._tokens = 0
+            self._paused_until = max(self._paused_until, now + pause)
+
+
+class RetryPolicy:
+
+    def __init__(self, retries: int = 8, base_delay: float = 1, max_delay: float = 300):
+
+        self.retries = retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    @staticmethod
+    def retry_after(header: Optional[str]) -> Optional[float]:
+        """Reads a Retry-After header given in seconds or as date."""
+        if not header:
+            return None
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(header)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Exponential backoff with full jitter. A Retry-After
+        given by the server is never undercut."""
+        backoff = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+        if retry_after is not None:
+            return max(backoff, min(retry_after, self._max_delay))
+        return backoff
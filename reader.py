@@ -0,0 +1,180 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Reads the articles a scrape wrote to the segment store
+(see store.py). Articles can be looked up by title or by the
+name of one of their redirects, iterated in the order they
+are stored on disk, or scanned in bulk through memory-mapped
+segments.
+"""
+
+import json
+import mmap
+import os
+from typing import Dict, Iterator, List, Match, Optional, Pattern, Tuple
+from store import INDEX_SUFFIX, SEGMENT_SUFFIXES
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ScrapeReader:
+
+    def __init__(self, path: str):
+
+        self._path = path
+        # title -> (segment, offset, length)
+        self._locations = dict()
+        # title -> redirects stored with it
+        self._redirect_lists = dict()
+        self._maps = dict()
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+        # index lines which were cut short, see _load_index
+        self.torn_lines = 0
+        # title -> when the entry in _locations was written
+        written = dict()
+        for name in sorted(os.listdir(path)):
+            if name.endswith(INDEX_SUFFIX):
+                self._load_index(os.path.join(path, name), written)
+        # redirect -> title
+        self._redirects = {redirect: title
+                           for title, redirects in self._redirect_lists.items()
+                           for redirect in redirects}
+
+    def _load_index(self, path: str, written: Dict[str, int]):
+        """Reads an index file. If an article was written more
+        than once the newest entry wins, its redirects included.
+        Entries of older stores carry no write time; they lose to
+        any entry which does, and among each other the last one
+        read wins.
+        A worker killed while it wrote its index can leave a line
+        cut short. Such lines are skipped and counted in torn_lines,
+        their articles are not journaled and scraped again."""
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    if not line.endswith("\n") or len(fields) < 4:
+                        raise ValueError(line)
+                    title, segment, offset, length, *redirects = fields
+                    offset, length = int(offset), int(length)
+                    stamp = 0
+                    if redirects and redirects[0].startswith("#"):
+                        stamp = int(redirects.pop(0)[1:])
+                except ValueError:
+                    self.torn_lines += 1
+                    continue
+                if stamp < written.get(title, 0):
+                    continue
+                written[title] = stamp
+                self._locations[title] = (segment, offset, length)
+                self._redirect_lists[title] = redirects
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def __contains__(self, name: str) -> bool:
+        return self.resolve(name) is not None
+
+    def resolve(self, name: str) -> Optional[str]:
+        """Returns the title of the article stored under name,
+        following redirects."""
+        if name in self._locations:
+            return name
+        return self._redirects.get(name)
+
+    def titles(self) -> List[str]:
+        return list(self._locations)
+
+    def redirects(self, title: str) -> List[str]:
+        """Returns the redirects an article was stored with."""
+        return self._redirect_lists.get(title, [])
+
+    def _segment(self, segment: str) -> mmap.mmap:
+        if segment not in self._maps:
+            with open(os.path.join(self._path, segment), "rb") as file:
+                self._maps[segment] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[segment]
+
+    def _decode(self, segment: str, record) -> bytes:
+        if segment.endswith(SEGMENT_SUFFIXES["zstd"]):
+            if self._decompressor is None:
+                raise Exception("Compressed segments need the zstandard package.")
+            return self._decompressor.decompress(record)
+        return bytes(record)
+
+    def get(self, name: str) -> Optional[str]:
+        """Returns the Json of an article, looked up by its title
+        or a redirect name, or None if it was not scraped."""
+        title = self.resolve(name)
+        if title is None:
+            return None
+        segment, offset, length = self._locations[title]
+        record = memoryview(self._segment(segment))[offset:offset + length]
+        try:
+            return self._decode(segment, record).decode("utf-8").rstrip("\n")
+        finally:
+            record.release()
+
+    def get_obj(self, name: str) -> Optional[Dict]:
+        content = self.get(name)
+        return json.loads(content) if content is not None else None
+
+    def _ordered(self) -> List[Tuple[str, str, int, int]]:
+        return sorted(((segment, offset, length, title)
+                       for title, (segment, offset, length) in self._locations.items()))
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        """Yields (title, Json) pairs in the order they are stored,
+        so segments are read front to back."""
+        for segment, offset, length, title in self._ordered():
+            yield title, self.get(title)
+
+    def scan(self) -> Iterator[Tuple[str, memoryview]]:
+        """Yields (title, record) for bulk processing. Records are
+        views into the memory-mapped segments, decompressed where
+        needed; a view is only valid until the next one is yielded."""
+        for segment, offset, length, title in self._ordered():
+            record = memoryview(self._segment(segment))[offset:offset + length]
+            if segment.endswith(SEGMENT_SUFFIXES["zstd"]):
+                decoded = memoryview(self._decode(segment, record))
+                record.release()
+                record = decoded
+            try:
+                yield title, record
+            finally:
+                record.release()
+
+    def search(self, pattern: Pattern[bytes], chunk_size: int = 2**16) -> Iterator[Tuple[str, Optional[Match]]]:
+        """Yields (title, first match of pattern in the Json) for all
+        articles in the order they are stored. A compressed article
+        is only decompressed until the pattern matches, so fields
+        before raw_html are found without inflating the whole page."""
+        for segment, offset, length, title in self._ordered():
+            record = self._segment(segment)[offset:offset + length]
+            if not segment.endswith(SEGMENT_SUFFIXES["zstd"]):
+                yield title, pattern.search(record)
+                continue
+            if self._decompressor is None:
+                raise Exception("Compressed segments need the zstandard package.")
+            decoded = b""
+            with self._decompressor.stream_reader(record) as stream:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    decoded += chunk
+                    match_obj = pattern.search(decoded)
+                    if match_obj or not chunk:
+                        break
+            yield title, match_obj
+
+    def close(self):
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = dict()
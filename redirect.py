@@ -9,10 +9,65 @@ Oktober 2019
 Expects a Wikipedia redirect dump and a
 Wikipedia page dump and returns a dict
 mapping main pages to all its redirects.
+
+Only articles can be scraped, so pages outside the article
+namespace, pages whose content model is not wikitext (such as
+Stummi/monobook.css) and redirects to anything but an article
+are dropped while the dumps are read. What was dropped is
+counted by reason and printed at the end.
 """
 
-from collections import defaultdict
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
 import json
+from dump import iter_rows, split
+from title_index import write_index
+
+ARTICLE_NAMESPACE = 0
+# None in dumps which leave the default model of the namespace out
+CONTENT_MODELS = ("wikitext", None)
+
+
+def _redirect_titles(chunk: Tuple[str, int, int]
+                     ) -> Tuple[List[Tuple[int, str]], List[Tuple[str, Tuple[int, int]]], Counter]:
+    """Reads the (number, title) pairs of all redirect pages and
+    the (title, (page_len, page_latest)) pairs of all articles in
+    one chunk of the page dump, and counts the pages dropped."""
+    # A row looks like this:
+    # (1, 0, 'Alan_Smithee', '', 0, 0, 0.0864337124735431,
+    # '20190824111515', '20190824111815', 183851697,
+    # 7788, 'wikitext', NULL)
+    path, start, end = chunk
+    redirects, pages, dropped = [], [], Counter()
+    for row in iter_rows(path, "page", start, end):
+        if row[1] != ARTICLE_NAMESPACE:
+            dropped["page_namespace"] += 1
+        elif row[4]:
+            redirects.append((row[0], row[2]))
+        elif row[11] not in CONTENT_MODELS:
+            dropped["content_model"] += 1
+        else:
+            pages.append((row[2], (row[10], row[9])))
+    return redirects, pages, dropped
+
+
+def _redirect_targets(chunk: Tuple[str, int, int]) -> Tuple[List[Tuple[int, str]], Counter]:
+    """Reads the (number of redirect, title of main page)
+    pairs in one chunk of the redirect dump, leaving out the
+    redirects to other namespaces and other wikis."""
+    # A row looks like this:
+    # (8, 0, 'Anschluss_(Soziologie)', '', '')
+    path, start, end = chunk
+    pairs, dropped = [], Counter()
+    for row in iter_rows(path, "redirect", start, end):
+        if row[1] != ARTICLE_NAMESPACE:
+            dropped["redirect_namespace"] += 1
+        elif row[3]:
+            dropped["interwiki"] += 1
+        else:
+            pairs.append((row[0], row[2]))
+    return pairs, dropped
 
 
 class RedirectCreater:
@@ -20,6 +75,10 @@ class RedirectCreater:
     def __init__(self):
 
         self._config = self._load_config()
+        self._processes = self._config["dump_processes"]
+        # title -> (page_len, page_latest)
+        self._pages = dict()
+        self.dropped = Counter()
         self._no_title_mapping = self.get_no_title_mapping()
         self._main_redirects_mapping = self.get_main_redirects_mapping()
 
@@ -33,71 +92,63 @@ class RedirectCreater:
         return self._main_redirects_mapping
 
     def save(self):
-        with open(self._config["dumps_path"] + "main_to_redirect.txt", "w") as file:
-            file.write(str(self._main_redirects_mapping))
-
-    def get_main_redirects_mapping(self):
-        counter = 0
+        write_index(self._config["dumps_path"] + "main_to_redirect.idx",
+                    self._main_redirects_mapping, self._pages)
+
+    def _read_chunks(self, function, path: str):
+        """Splits a dump into chunks and yields what function
+        returns for each chunk, in file order. Several chunks per
+        process keep the results held at once small."""
+        chunks = [(path, start, end) for start, end in split(path, self._processes * 8)]
+        if self._processes == 1:
+            yield from map(function, chunks)
+            return
+        with Pool(self._processes) as pool:
+            yield from pool.imap(function, chunks)
+
+    def get_main_redirects_mapping(self) -> Dict[str, List[str]]:
         redirect_mapping = defaultdict(list)
-        with open(self._config["dumps_path"] + "dewiki-20191001-redirect.txt", "r") as file:
-            line = file.readline()
-            while line:
-                delimiter = "INSERT INTO `redirect` VALUES "
-                if line.startswith(delimiter):
-
-                    # Gets a list of tuples like this:
-                    # (8, 0, 'Anschluss_(Soziologie)', '', '')
-                    NULL = "NULL"
-                    elements = eval(f"[{line[len(delimiter):-2]}]")
-
-                    for element in elements:
-
-                        # Extract number of title, title name and save it
-                        main = element[2]
-                        try:
-                            redirect = self._no_title_mapping[element[0]]
-                        except KeyError:
-                            continue
-                        redirect_mapping[main].append(redirect)
-
-                    print(f"Complete redirect mapping: Line {counter} done.")
-                    counter += 1
-
-                line = file.readline()
+        path = self._config["dumps_path"] + "dewiki-20191001-redirect.txt"
+        for counter, (pairs, dropped) in enumerate(self._read_chunks(_redirect_targets, path)):
+            self.dropped.update(dropped)
+            for number, main in pairs:
+                # Extract number of title, title name and save it
+                try:
+                    redirect = self._no_title_mapping[number]
+                except KeyError:
+                    # the redirect page itself was dropped
+                    self.dropped["redirect_source"] += 1
+                    continue
+                if main not in self._pages:
+                    # a redirect, a dropped page or no page at all
+                    self.dropped["redirect_target"] += 1
+                    continue
+                redirect_mapping[main].append(redirect)
+            print(f"Complete redirect mapping: Chunk {counter} done.")
         return dict(redirect_mapping)
 
-    def get_no_title_mapping(self):
+    def get_no_title_mapping(self) -> Dict[int, str]:
+        """Maps the numbers of all redirect pages to their titles.
+        Only redirect pages can appear as the source of a redirect,
+        so the other pages are never kept in memory, only their
+        page_len which lets the scheduler start the long ones first
+        and their latest revision for incremental scrapes."""
         no_title_mapping = dict()
-        counter = 0
-        with open(self._config["dumps_path"] + "dewiki-20191001-page.txt", "r") as file:
-            line = file.readline()
-            while line:
-                delimiter = "INSERT INTO `page` VALUES "
-                if line.startswith(delimiter):
-
-                    # Gets a list of tuples like this:
-                    # (1, 0, 'Alan_Smithee', '', 0, 0, 0.0864337124735431,
-                    # '20190824111515', '20190824111815', 183851697,
-                    # 7788, 'wikitext', NULL)
-
-                    NULL = "NULL"
-                    elements = eval(f"[{line[len(delimiter):-2]}]")
-
-                    for element in elements:
-
-                        # Extract title id and title name
-                        # Save it to dict
-                        if element[0] in no_title_mapping:
-                            raise Exception("Number-title pair must be unique.")
-                        no_title_mapping[element[0]] = element[2]
-
-                    print(f"Number title mapping: Line {counter} done.")
-                    counter += 1
-
-                line = file.readline()
-
+        path = self._config["dumps_path"] + "dewiki-20191001-page.txt"
+        for counter, (pairs, pages, dropped) in enumerate(self._read_chunks(_redirect_titles, path)):
+            self._pages.update(pages)
+            self.dropped.update(dropped)
+            for number, title in pairs:
+                # Save title id and title name to dict
+                if number in no_title_mapping:
+                    raise Exception("Number-title pair must be unique.")
+                no_title_mapping[number] = title
+            print(f"Number title mapping: Chunk {counter} done.")
         return no_title_mapping
 
 
-r = RedirectCreater()
-r.save()
\ No newline at end of file
+if __name__ == "__main__":
+    r = RedirectCreater()
+    r.save()
+    for reason, count in r.dropped.most_common():
+        print(f"Dropped {count} for {reason}.")
@@ -0,0 +1,381 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Central work queue of a scrape.
+
+Instead of a fixed share of the title index per script, every
+script leases small batches of entry numbers whenever it needs
+more work, so a script stuck on a block of huge lists no longer
+finishes long after the others. A lease runs out unless its
+script renews it, and a batch whose lease ran out is handed to
+the next script asking for work. A script renews only the leases
+of batches it is getting on with, so one stuck on a batch loses
+it while it keeps renewing the others. With cost ordering the entries
+are sorted by their page_len, so the longest articles start
+first and the scrape does not end waiting on one of them.
+
+Every lease of a batch gets the next attempt number, and only
+the holder of the latest attempt can complete the batch. A
+script whose lease ran out while it was still working on the
+batch is told so instead of completing it a second time.
+
+A batch with titles whose request failed is not completed but
+failed, and handed out again right away; the journal leaves only
+those titles to the next attempt. After max_failures failed
+attempts the batch is given up on for this run: with "manager"
+the next scrape builds the queue anew, with "sqlite" the next
+script to open the database hands it out again.
+
+There are two backends, chosen by "backend" in the "scheduler"
+section of config.json:
+
+    manager     the queue lives in one process and is served to
+                the others over TCP by a multiprocessing manager.
+                The supervisor hosts it, or else the first script
+                to start. Other machines connect to its address.
+    sqlite      the queue is a table in an SQLite database which
+                every script opens itself, e.g. on a filesystem
+                shared by several machines. It outlives the
+                scripts, so a scrape continues where it stopped.
+                Lease deadlines are wall clock times, so the
+                clocks of the machines have to be in sync.
+
+    queue = open_queue(config["scheduler"], titles)
+"""
+
+import os
+import sqlite3
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+from threading import Lock, Thread
+from typing import Dict, Iterator, List, Optional, Tuple
+from metrics import REGISTRY
+from title_index import TitleIndex
+
+BATCHES = REGISTRY.counter("wiki_scheduler_batches_total", "Batches handed out and finished, by event", ["event"])
+
+# (batch, attempt, entry numbers)
+Lease = Tuple[int, int, List[int]]
+
+
+class Batches:
+    """Cuts the entries of a title index into batches, in index
+    order or longest page first. Every process computes the same
+    batches from the same index."""
+
+    def __init__(self, count: int, batch_size: int, costs: Optional[array] = None):
+
+        self.count = count
+        self.batch_size = batch_size
+        self.ordered = costs is not None and any(costs)
+        self._order = None
+        if self.ordered:
+            # stable, so entries of equal cost keep their index order
+            self._order = array("I", sorted(range(count), key=costs.__getitem__, reverse=True))
+
+    def __len__(self) -> int:
+        return -(-self.count // self.batch_size)
+
+    def entries(self, batch: int) -> List[int]:
+        start = batch * self.batch_size
+        end = min(start + self.batch_size, self.count)
+        if self._order is None:
+            return list(range(start, end))
+        return self._order[start:end].tolist()
+
+
+class WorkQueue:
+
+    def __init__(self, batches: Batches, lease_timeout: float = 600, max_failures: int = 3):
+
+        self._batches = batches
+        self._lease_timeout = lease_timeout
+        self._max_failures = max_failures
+        self._next = 0
+        # batch -> (worker, deadline), oldest deadline first
+        self._leases = OrderedDict()
+        self._attempts = dict()
+        self._reissue = []
+        self._completed = set()
+        # batch -> failed attempts
+        self._failures = dict()
+        self._given_up = set()
+        self._lock = Lock()
+
+    def _expire(self, now: float):
+        while self._leases:
+            batch, (worker, deadline) = next(iter(self._leases.items()))
+            if deadline > now:
+                return
+            del self._leases[batch]
+            self._reissue.append(batch)
+
+    def lease(self, worker: str) -> Optional[Lease]:
+        """Hands out a batch as (batch number, attempt, entry
+        numbers). Batches whose lease ran out go first. Returns
+        None if every batch is either finished or leased."""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if self._reissue:
+                batch = self._reissue.pop(0)
+                BATCHES.inc(event="reissued")
+            elif self._next < len(self._batches):
+                batch = self._next
+                self._next += 1
+            else:
+                return None
+            self._leases[batch] = (worker, now + self._lease_timeout)
+            self._attempts[batch] = self._attempts.get(batch, -1) + 1
+            BATCHES.inc(event="leased")
+            return batch, self._attempts[batch], self._batches.entries(batch)
+
+    def renew(self, worker: str, leases: List[Tuple[int, int]]) -> int:
+        """Extends the given (batch, attempt) leases of a worker,
+        returns how many it still held."""
+        with self._lock:
+            deadline = time.monotonic() + self._lease_timeout
+            batches = [batch for batch, attempt in leases
+                       if self._leases.get(batch, (None,))[0] == worker and self._attempts.get(batch) == attempt]
+            for batch in batches:
+                self._leases[batch] = (worker, deadline)
+                self._leases.move_to_end(batch)
+            return len(batches)
+
+    def release(self, worker: str) -> int:
+        """Hands the batches of a worker which is known to be gone
+        out again right away instead of after their lease timeout."""
+        with self._lock:
+            batches = [batch for batch, (holder, _) in self._leases.items() if holder == worker]
+            for batch in batches:
+                del self._leases[batch]
+                self._reissue.append(batch)
+            return len(batches)
+
+    def complete(self, batch: int, attempt: int) -> bool:
+        """Marks a batch as finished. Returns False if it already
+        is, or if it was leased again since this attempt."""
+        with self._lock:
+            if not self._end_lease(batch, attempt):
+                return False
+            self._completed.add(batch)
+            del self._attempts[batch]
+            BATCHES.inc(event="completed")
+            return True
+
+    def fail(self, batch: int, attempt: int) -> bool:
+        """Hands a batch some titles of which could not be fetched
+        out again right away, or gives up on it after max_failures
+        failed attempts. Returns False like complete."""
+        with self._lock:
+            if not self._end_lease(batch, attempt):
+                return False
+            self._failures[batch] = self._failures.get(batch, 0) + 1
+            if self._failures[batch] >= self._max_failures:
+                self._given_up.add(batch)
+                del self._attempts[batch]
+                BATCHES.inc(event="given_up")
+            else:
+                # the attempt number moves on, so the failed attempt is stale
+                self._attempts[batch] = attempt + 1
+                self._reissue.append(batch)
+                BATCHES.inc(event="failed")
+            return True
+
+    def _end_lease(self, batch: int, attempt: int) -> bool:
+        """Ends the lease of an attempt. Returns False if the batch
+        is finished or was leased again since."""
+        if batch in self._completed or batch in self._given_up or self._attempts.get(batch) != attempt:
+            BATCHES.inc(event="stale")
+            return False
+        self._leases.pop(batch, None)
+        if batch in self._reissue:
+            self._reissue.remove(batch)
+        return True
+
+    def finished(self) -> bool:
+        with self._lock:
+            return len(self._completed) + len(self._given_up) == len(self._batches)
+
+    def status(self) -> Dict[str, int]:
+        with self._lock:
+            return {"batches": len(self._batches), "completed": len(self._completed),
+                    "given_up": len(self._given_up), "leased": len(self._leases),
+                    "waiting": len(self._batches) - self._next + len(self._reissue)}
+
+
+class SqliteWorkQueue:
+    """The WorkQueue as a table of an SQLite database. Every call
+    is one transaction, so any number of processes on any number
+    of machines can share the file. It keeps the rollback journal,
+    as WAL does not work on network filesystems. A batch given up
+    on has done = 2 until the next script opens the database."""
+
+    def __init__(self, path: str, batches: Batches, lease_timeout: float = 600, max_failures: int = 3):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._batches = batches
+        self._lease_timeout = lease_timeout
+        self._max_failures = max_failures
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA synchronous=FULL")
+        layout = {"count": batches.count, "batch_size": batches.batch_size, "ordered": int(batches.ordered)}
+        with self._transaction():
+            self._db.execute("CREATE TABLE IF NOT EXISTS layout (key TEXT PRIMARY KEY, value INTEGER)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS batches (batch INTEGER PRIMARY KEY, "
+                             "attempt INTEGER NOT NULL DEFAULT -1, worker TEXT, deadline REAL, "
+                             "done INTEGER NOT NULL DEFAULT 0, failures INTEGER NOT NULL DEFAULT 0)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS pending ON batches (batch) WHERE done = 0")
+            if "failures" not in [row[1] for row in self._db.execute("PRAGMA table_info(batches)")]:
+                self._db.execute("ALTER TABLE batches ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+            stored = dict(self._db.execute("SELECT key, value FROM layout"))
+            if not stored:
+                self._db.executemany("INSERT INTO layout VALUES (?, ?)", layout.items())
+                self._db.executemany("INSERT INTO batches (batch) VALUES (?)",
+                                     ((batch,) for batch in range(len(batches))))
+            elif stored != layout:
+                raise Exception(f"{path} holds the batches of another title index or batch size.")
+            self._db.execute("UPDATE batches SET done = 0, failures = 0, worker = NULL, deadline = NULL "
+                             "WHERE done = 2")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """BEGIN IMMEDIATE takes the write lock of the database
+        right away, so two scripts never lease the same batch."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def lease(self, worker: str) -> Optional[Lease]:
+        with self._transaction():
+            now = time.time()
+            row = self._db.execute("SELECT batch, attempt FROM batches WHERE done = 0 "
+                                   "AND (deadline IS NULL OR deadline < ?) ORDER BY batch LIMIT 1",
+                                   (now,)).fetchone()
+            if row is None:
+                return None
+            batch, attempt = row[0], row[1] + 1
+            self._db.execute("UPDATE batches SET attempt = ?, worker = ?, deadline = ? WHERE batch = ?",
+                             (attempt, worker, now + self._lease_timeout, batch))
+        if attempt:
+            BATCHES.inc(event="reissued")
+        BATCHES.inc(event="leased")
+        return batch, attempt, self._batches.entries(batch)
+
+    def renew(self, worker: str, leases: List[Tuple[int, int]]) -> int:
+        with self._transaction():
+            deadline = time.time() + self._lease_timeout
+            return sum(self._db.execute("UPDATE batches SET deadline = ? WHERE batch = ? AND attempt = ? "
+                                        "AND worker = ? AND done = 0",
+                                        (deadline, batch, attempt, worker)).rowcount
+                       for batch, attempt in leases)
+
+    def release(self, worker: str) -> int:
+        with self._transaction():
+            return self._db.execute("UPDATE batches SET deadline = 0 WHERE worker = ? AND done = 0",
+                                    (worker,)).rowcount
+
+    def complete(self, batch: int, attempt: int) -> bool:
+        with self._transaction():
+            completed = self._db.execute("UPDATE batches SET done = 1, worker = NULL, deadline = NULL "
+                                         "WHERE batch = ? AND attempt = ? AND done = 0",
+                                         (batch, attempt)).rowcount == 1
+        BATCHES.inc(event="completed" if completed else "stale")
+        return completed
+
+    def fail(self, batch: int, attempt: int) -> bool:
+        with self._transaction():
+            row = self._db.execute("SELECT failures FROM batches WHERE batch = ? AND attempt = ? AND done = 0",
+                                   (batch, attempt)).fetchone()
+            if row is not None:
+                given_up = row[0] + 1 >= self._max_failures
+                # the attempt number moves on, so the failed attempt is stale
+                self._db.execute("UPDATE batches SET attempt = ?, done = ?, failures = failures + 1, "
+                                 "worker = NULL, deadline = 0 WHERE batch = ?",
+                                 (attempt + 1, 2 if given_up else 0, batch))
+        if row is None:
+            BATCHES.inc(event="stale")
+            return False
+        BATCHES.inc(event="given_up" if given_up else "failed")
+        return True
+
+    def finished(self) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM batches WHERE done = 0 LIMIT 1").fetchone() is None
+
+    def status(self) -> Dict[str, int]:
+        with self._lock:
+            completed, given_up, leased = self._db.execute(
+                "SELECT COALESCE(SUM(done = 1), 0), COALESCE(SUM(done = 2), 0), "
+                "COALESCE(SUM(done = 0 AND deadline >= ?), 0) FROM batches",
+                (time.time(),)).fetchone()
+        return {"batches": len(self._batches), "completed": completed, "given_up": given_up,
+                "leased": leased, "waiting": len(self._batches) - completed - given_up - leased}
+
+    def close(self):
+        self._db.close()
+
+
+class SchedulerManager(BaseManager):
+    pass
+
+
+def serve_queue(queue: WorkQueue, address: Tuple[str, int], authkey: bytes) -> Thread:
+    """Serves a queue to the other processes from a thread of
+    this one. Raises OSError if the address is taken."""
+    SchedulerManager.register("queue", callable=lambda: queue)
+    server = SchedulerManager(address, authkey).get_server()
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def connect_queue(address: Tuple[str, int], authkey: bytes) -> WorkQueue:
+    """Returns a proxy of the queue served at address."""
+    SchedulerManager.register("queue")
+    manager = SchedulerManager(address, authkey)
+    manager.connect()
+    return manager.queue()
+
+
+def open_queue(config: Dict, titles: TitleIndex):
+    """Opens the queue of the configured backend. With "manager"
+    it connects to the queue of a running scrape or, if there is
+    none yet, builds one over the title index and serves it."""
+
+    def batches() -> Batches:
+        return Batches(len(titles), config["batch_size"], titles.lengths() if config["cost_order"] else None)
+
+    if config["backend"] == "sqlite":
+        return SqliteWorkQueue(config["path"], batches(), config["lease_timeout"], config["max_failures"])
+    if config["backend"] != "manager":
+        raise Exception(f"Unknown scheduler backend {config['backend']}.")
+    address = (config["address"][0], config["address"][1])
+    authkey = config["authkey"].encode("utf-8")
+    try:
+        return connect_queue(address, authkey)
+    except ConnectionRefusedError:
+        pass
+    queue = WorkQueue(batches(), config["lease_timeout"], config["max_failures"])
+    try:
+        serve_queue(queue, address, authkey)
+    except OSError:
+        # another script was faster
+        return connect_queue(address, authkey)
+    return queue
@@ -12,12 +12,31 @@ Requests the webpage for every title and saves the HTML
 content accordingly.
 """
 
+import asyncio
 import json
 import os
+import signal
+import socket
 import sys
-from itertools import islice
-from typing import Dict, List, Optional
-from format import Formatter
+import threading
+from threading import Lock
+from typing import AsyncIterator, Callable, Iterable, List, Optional, Tuple
+from fetch import Fetcher
+from journal import Journal
+from logger import LOGGER, setup_logging
+from metrics import REGISTRY, start_stats
+from pipeline import Pipeline
+from scheduler import open_queue
+from store import SegmentWriter
+from title_index import TitleIndex
+
+ARTICLES = REGISTRY.counter("wiki_scraper_articles_total", "Titles finished, by result", ["result"])
+
+
+def worker_name(script_no: int, pid: int) -> str:
+    """The name a script leases batches under, unique across the
+    machines sharing a work queue."""
+    return f"scraper_{script_no}-{socket.gethostname()}-{pid}"
 
 
 class Scraper:
@@ -25,16 +44,22 @@ class Scraper:
     def __init__(self,
                  language: str = "de",
                  script_no: int = None,
-                 no_of_scripts: int = None
+                 no_of_scripts: int = None,
+                 heartbeat: Callable[[int], None] = None
                 ):
 
         self._config = self._load_config()
         self._script_no = script_no if script_no else int(sys.argv[1])
         self._no_of_scripts = no_of_scripts if no_of_scripts else int(sys.argv[2])
         self._language = language if language else "de"# sys.argv[3]
-        self._titles = self._get_titles()
-        self._saved_state = self._get_state()
-        self._start_index = self._get_start_index()
+        self._worker = worker_name(self._script_no, os.getpid())
+        # called with the number of titles finished since the last call,
+        # with 0 while waiting for work
+        self._heartbeat = heartbeat
+        self._stopping = False
+        self._titles = TitleIndex(self._config["titles_path"])
+        self._journal = Journal(self._config["state_path"] + "journal.sqlite",
+                                **self._config["journal"])
 
 
     @staticmethod
@@ -42,91 +67,261 @@ class Scraper:
         with open("config.json", "r") as file:
             return json.loads(str(file.read()))
 
-    def _get_titles(self):
-        """Gets the scraped titles from file and splits the list."""
-        with open(self._config["titles_path"], "r") as file:
-            titles = eval(file.read())
-            titles = self._split(titles)
-            return titles
-
-    def _split(self, titles: Dict[str, List[str]]) -> Dict[str, List[str]]:
-        """Splits the titles list depending on the script number and how
-        scripts are run at the same time. Say you're running 10 scripts
-        at the same time script number 1 will get the first 10th of the
-        titles. Script number two will scrape the second 10th."""
-        start_index = 0 if self._script_no == 1 else (int(len(titles) * (self._script_no-1)/self._no_of_scripts) - 1)
-        end_index = int(len(titles) * self._script_no/self._no_of_scripts)
-        return dict(islice(titles.items(), start_index, end_index))
-
-    def _save_state(self, title):
-        """Saves where to continue."""
-        path = self._config["state_path"] + f"saved_{self._script_no}.txt"
-        try:
-            with open(path, "w") as file:
-                file.write(title)
-        except FileNotFoundError:
-            self._create_dir("Saved")
-            self._save_state(title)
-
-    def _get_state(self) -> Optional[str]:
-        """Reads where to continue."""
-        path = self._config["state_path"] + f"saved_{self._script_no}.txt"
+    def scrape(self):
+        """Main programm."""
+        asyncio.run(self._scrape())
+
+    def stop(self):
+        """Stops leasing batches and starting titles. The pages in
+        flight are still written, flushed and journaled."""
+        self._stopping = True
+
+    async def _scrape(self):
+        """Runs the fetch, format and write stages of the pipeline
+        over the batches the scheduler hands out until all of them
+        are finished. One pipeline runs for the whole scrape, so the
+        titles of the next batch are fetched while a straggler of
+        the last one is still retried. Calls to the scheduler and the
+        journal block, so they run in threads, never on the event
+        loop the fetches run on."""
+        self._unflushed = []
+        # (batch, attempt) -> titles of it which are not in the journal yet
+        self._outstanding = dict()
+        # (batch, attempt) -> titles of it being fetched or formatted
+        self._in_flight = dict()
+        # titles of all batches being fetched or formatted, and
+        # set once there are none
+        self._running = 0
+        self._drained = asyncio.Event()
+        # leases which had a title written or dropped since the last renewal
+        self._progressed = set()
+        # leases which had a title dropped, failed instead of completed
+        self._failed = set()
+        self._lock = Lock()
+        # the store and _unflushed, used by the writer and by _flush
+        self._writing = Lock()
+        self._lost = False
+        self._prefetch = None
+        self._background = set()
+        scheduler = self._config["scheduler"]
+        stats = start_stats(self._config["metrics"], f"scraper_{self._script_no}")
+        logs = setup_logging(self._config["logging"], f"scraper_{self._script_no}")
+        # named after the worker, so scripts of the same number on other
+        # machines sharing save_path never append to the same files
+        self._store = SegmentWriter(self._config["save_path"], f"content_{self._worker}",
+                                    **self._config["store"])
+        self._queue = open_queue(scheduler, self._titles)
+        self._loop = asyncio.get_running_loop()
+        if threading.current_thread() is threading.main_thread():
+            for signal_no in (signal.SIGINT, signal.SIGTERM):
+                self._loop.add_signal_handler(signal_no, self.stop)
+        renewing = asyncio.ensure_future(self._renew(scheduler["lease_timeout"] / 3))
+        pipeline = None
         try:
-            with open(path, "r") as file:
-                return str(file.read())
-        except FileNotFoundError:
-            return None
+            async with Fetcher.from_config(self._language, self._config["fetch"], self._no_of_scripts) as fetcher:
+                pipeline = Pipeline(fetcher, self._language, self._config["single_pass"],
+                                    metrics=self._config["metrics"], logging=self._config["logging"],
+                                    fields=self._config["fields"], serializer=self._config["serializer"],
+                                    **self._config["pipeline"])
+                await pipeline.run(self._pending(scheduler["poll_interval"]), self._write, self._dropped)
+        finally:
+            renewing.cancel()
+            if pipeline:
+                await asyncio.to_thread(pipeline.close)
+            if self._prefetch:
+                # leased but not started, it is reissued once its lease runs out
+                await asyncio.gather(self._prefetch, return_exceptions=True)
+            await self._settled()
+            self._store.close()
+            self._journal_unflushed()
+            self._journal.close()
+            if stats:
+                stats.stop()
+            if logs:
+                logs.stop()
 
-    def _get_start_index(self) -> int:
-        """Determines index of where to continue by
-        the name which is saved in the saved file."""
-        count = 0
-        if not self._saved_state:
-            return count
-        for title in self._titles:
-            if title == self._saved_state:
-                return count
-            count += 1
-
-    def _create_dir(self, name: str):
-        """Creates a directory at the specified path."""
-        os.makedirs(self._config["save_path"] + name)
-
-    def _save_content(self, title: str, content: str):
-        """Saves an article at the specified path."""
-        title = title.replace("/", "-")
+    def _call(self, method: str, *args):
+        """Calls the scheduler. If the script hosting it is gone,
+        the scrape ends and what is not journaled is done by the
+        next run."""
+        if self._lost:
+            return None
         try:
-            # slice to prevent FileTooLongError
-            name = self._config["save_path"] + f"Content_{self._script_no}/" + title[:255]
-            with open(name + ".txt", "w") as file:
-                file.write(content)
-        except FileNotFoundError:
-            self._create_dir(f"Content_{self._script_no}")
-            self._save_content(title, content)
+            return getattr(self._queue, method)(*args)
+        except (OSError, EOFError) as e:
+            self._lost = True
+            LOGGER.warning("Lost the scheduler.", extra={"reason": "scheduler_lost", "error": repr(e)})
+            return None
 
-    @staticmethod
-    def _notify(index: int, title: str):
-        """Printer."""
-        os.system('clear')
-        print(f"Now scraping: {title}.")
-        print(f"File {index}.")
+    async def _renew(self, interval: float):
+        """Renews the leases of the batches which made progress
+        since the last renewal, and of those whose titles are all
+        written and only wait for the store to flush. A batch stuck
+        on a title runs out and goes to another script."""
+        while True:
+            await asyncio.sleep(interval)
+            with self._lock:
+                leases = self._progressed | {lease for lease, count in self._in_flight.items()
+                                             if not count and lease in self._outstanding}
+                self._progressed = set()
+            if leases:
+                await asyncio.to_thread(self._call, "renew", self._worker, list(leases))
 
+    def _next_batch(self) -> Optional[Tuple[Tuple[int, int], List[Tuple[str, List[str], int]]]]:
+        """Leases a batch and returns its lease with the titles of
+        it which are not in the journal yet. Batches without any are
+        completed and the next one is leased. Runs in a thread."""
+        while not self._stopping:
+            lease = self._call("lease", self._worker)
+            if not lease:
+                return None
+            number, attempt, entries = lease
+            items = []
+            for index in entries:
+                title, redirects = self._titles[index]
+                if title not in self._journal:
+                    items.append((title, redirects, index))
+            if items:
+                with self._lock:
+                    self._outstanding[(number, attempt)] = len(items)
+                return (number, attempt), items
+            self._complete([(number, attempt)])
+        return None
 
-    def scrape(self):
-        """Main programm."""
-        formatter = Formatter(self._language)
-        for index, (main_title, redirects) in enumerate(self._titles.items()):
-            # ensures to continue where script left off
-            if self._start_index > index:
-                continue
-            self._notify(index, main_title)
-            content = formatter.format_with_title(main_title, redirects, pretty_print=False)
-            if not content:  # there are some files that need to be skipped
+    async def _pending(self, poll_interval: float
+                       ) -> AsyncIterator[Tuple[str, List[str], Tuple[Tuple[int, int], int]]]:
+        """Yields the titles of the batches this script leases. The
+        next batch is leased in a thread while the titles of one are
+        taken up. While the other scripts hold the last batches, it
+        waits to take over those whose lease runs out, and it ends
+        once all of them are finished or the script stops."""
+        while not self._lost and not self._stopping:
+            # the batch leased while the last one was taken up, if any
+            prefetch, self._prefetch = self._prefetch, None
+            batch = await (prefetch if prefetch else asyncio.to_thread(self._next_batch))
+            if not batch:
+                if await self._drain():
+                    # a batch with dropped titles may be back
+                    continue
+                # the batches of this script are only complete once
+                # its titles are journaled, so flush before waiting
+                await asyncio.to_thread(self._flush)
+                if self._lost or await asyncio.to_thread(self._call, "finished"):
+                    return
+                self._beat(0)
+                await asyncio.sleep(poll_interval)
                 continue
-            self._save_content(main_title, content)
-            self._save_state(main_title)
-            print("Sucessfully scrapped.")
+            self._prefetch = asyncio.ensure_future(asyncio.to_thread(self._next_batch))
+            lease, items = batch
+            with self._lock:
+                self._in_flight[lease] = 0
+            for title, redirects, index in items:
+                if self._stopping:
+                    # the rest of the batch is reissued once its lease runs out
+                    return
+                with self._lock:
+                    self._in_flight[lease] += 1
+                    self._running += 1
+                yield title, redirects, (lease, index)
+
+    async def _drain(self) -> bool:
+        """Waits until the titles this script has in flight are
+        written or dropped and their batches settled, instead of a
+        poll_interval. Returns False if there were none."""
+        self._drained.clear()
+        with self._lock:
+            running = self._running
+        if not running and not self._background:
+            return False
+        if running:
+            await self._drained.wait()
+        await self._settled()
+        return True
+
+    def _finished(self, lease: Tuple[int, int]):
+        """Notes that a title of a lease was written or dropped."""
+        with self._lock:
+            self._in_flight[lease] -= 1
+            self._progressed.add(lease)
+            self._running -= 1
+            if not self._running:
+                self._loop.call_soon_threadsafe(self._drained.set)
+
+    def _settle(self, leases: Iterable[Tuple[int, int]]):
+        """Counts titles of leased batches as done and completes the
+        batches without any titles left, or fails them if a title
+        of theirs was dropped."""
+        complete, fail = [], []
+        with self._lock:
+            for lease in leases:
+                self._outstanding[lease] -= 1
+                if self._outstanding[lease] <= 0:
+                    del self._outstanding[lease]
+                    self._in_flight.pop(lease, None)
+                    if lease in self._failed:
+                        self._failed.discard(lease)
+                        fail.append(lease)
+                    else:
+                        complete.append(lease)
+        self._complete(complete)
+        self._complete(fail, "fail")
+
+    def _complete(self, leases: Iterable[Tuple[int, int]], method: str = "complete"):
+        for number, attempt in leases:
+            if self._call(method, number, attempt) is False:
+                # written twice, the lease ran out and another script has the batch
+                LOGGER.warning("Lease of batch %s ran out before it was complete.", number,
+                               extra={"reason": "stale_lease"})
+
+    def _dropped(self, title: str, key: Tuple[Tuple[int, int], int]):
+        """A title whose request failed does not go to the journal,
+        and its batch is failed instead of completed, so the title
+        is leased again. Called on the event loop, so settling the
+        batch is left to a thread."""
+        with self._lock:
+            self._failed.add(key[0])
+        self._finished(key[0])
+        task = asyncio.ensure_future(asyncio.to_thread(self._settle, [key[0]]))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        self._beat(1)
+
+    async def _settled(self):
+        """Waits for the batches _dropped is settling."""
+        if self._background:
+            await asyncio.gather(*self._background)
+
+    def _beat(self, titles: int):
+        if self._heartbeat:
+            self._heartbeat(titles)
+
+    def _flush(self):
+        with self._writing:
+            self._store.flush()
+            self._journal_unflushed()
+
+    def _journal_unflushed(self):
+        self._journal.add(title for title, _ in self._unflushed)
+        self._settle(lease for _, lease in self._unflushed)
+        self._unflushed = []
+
+    def _write(self, title: str, key: Tuple[Tuple[int, int], int], content: Optional[bytearray]):
+        """Saves a formatted article to the segment store. Titles
+        go to the journal once the store has flushed them, and a
+        batch is complete once all of its titles are journaled."""
+        lease, index = key
+        self._finished(lease)
+        with self._writing:
+            flushed = False
+            if content:  # there are some files that need to be skipped
+                flushed = self._store.write(title, self._titles[index][1], content)
+            self._unflushed.append((title, lease))
+            if flushed:
+                self._journal_unflushed()
+        ARTICLES.inc(result="written" if content else "skipped")
+        self._beat(1)
 
 
-s = Scraper()
-s.scrape()
+if __name__ == "__main__":
+    s = Scraper()
+    s.scrape()
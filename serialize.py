@@ -0,0 +1,129 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Writes the content of a page as Json bytes.
+
+Heading trees and paragraphs are written straight from the
+Heading and Paragraph objects, without building dicts first.
+Every heading text is encoded once per page, not once for every
+paragraph below it. The other fields are plain dicts and lists
+and go to the backend as they are. Chunks are handed to a sink
+as they are written, and a paragraph is let go of once it is.
+
+There are two backends, chosen by "serializer" in config.json:
+
+    json        the standard library. The output is the same as
+                json.dumps(content, ensure_ascii=False,
+                separators=(',', ': ')).
+    orjson      faster, if orjson is installed. Writes no blank
+                after the colons.
+"""
+
+import json
+from json.encoder import encode_basestring
+from typing import Any, Callable, Dict, List, Mapping
+from wiki_objects import Heading, Paragraph
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ("json", "orjson")
+HEADING_LEVELS = (1, 2, 3, 4, 5, 6)
+
+
+class Serializer:
+
+    def __init__(self, backend: str = "json"):
+
+        if backend not in BACKENDS:
+            raise Exception(f"Unknown serializer backend {backend}.")
+        if backend == "orjson" and orjson is None:
+            raise Exception("The orjson backend needs the orjson package.")
+        if backend == "orjson":
+            self._string = orjson.dumps
+            self._value = orjson.dumps
+            self._colon = b":"
+        else:
+            self._string = lambda text: encode_basestring(text).encode("utf-8")
+            encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ": "))
+            self._value = lambda value: encoder.encode(value).encode("utf-8")
+            self._colon = b": "
+        self._keys = dict()
+
+    def _key(self, key: str) -> bytes:
+        if key not in self._keys:
+            self._keys[key] = self._string(key) + self._colon
+        return self._keys[key]
+
+    def dumps(self, content: Mapping[str, Any]) -> bytearray:
+        """Returns the Json of a page."""
+        buffer = bytearray()
+        self.write(content, buffer.extend)
+        return buffer
+
+    def write(self, content: Mapping[str, Any], sink: Callable[[bytes], Any]):
+        """Writes the Json of a page to sink chunk by chunk. A Heading
+        is written as its tree, a list of Paragraph objects as their
+        records and emptied while it is written, anything else by
+        the backend."""
+        texts = dict()
+        sink(b"{")
+        for number, (field, value) in enumerate(content.items()):
+            if number:
+                sink(b",")
+            sink(self._key(field))
+            if isinstance(value, Heading):
+                self._heading(value, sink, texts)
+            elif isinstance(value, list) and value and isinstance(value[0], Paragraph):
+                self._paragraphs(value, sink, texts)
+            else:
+                sink(self._value(value))
+        sink(b"}")
+
+    def _text(self, heading: Heading, texts: Dict[int, bytes]) -> bytes:
+        """The encoded text of a heading, once per page."""
+        encoded = texts.get(id(heading))
+        if encoded is None:
+            encoded = texts[id(heading)] = self._string(heading.text)
+        return encoded
+
+    def _heading(self, heading: Heading, sink: Callable[[bytes], Any], texts: Dict[int, bytes], level: int = 1):
+        sink(b"{" + self._key(f"h{level}_heading") + self._text(heading, texts))
+        if heading.subheadings:
+            sink(b"," + self._key(f"h{level + 1}_headings") + b"[")
+            for number, sub in enumerate(heading.subheadings):
+                if number:
+                    sink(b",")
+                self._heading(sub, sink, texts, level + 1)
+            sink(b"]")
+        sink(b"}")
+
+    def _paragraphs(self, paragraphs: List[Paragraph], sink: Callable[[bytes], Any], texts: Dict[int, bytes]):
+        """Writes the records of paragraphs, with their links if
+        the formatter extracted them."""
+        keys = [self._key(f"h{level}") for level in HEADING_LEVELS]
+        text_key, links_key, skippable_key = self._key("text"), self._key("links"), self._key("is_skippable")
+        true, false = self._value(True), self._value(False)
+        sink(b"[")
+        # pop from the end, so each paragraph goes once it is written
+        paragraphs.reverse()
+        first = True
+        while paragraphs:
+            paragraph = paragraphs.pop()
+            chunk = [b"{" if first else b",{", text_key, self._string(paragraph.text)]
+            first = False
+            for key, heading in zip(keys, paragraph.headings):
+                if heading:
+                    chunk += (b",", key, self._text(heading, texts))
+            if paragraph.links is not None:
+                chunk += (b",", links_key, self._value(paragraph.links.to_list()))
+            chunk += (b",", skippable_key, true if paragraph.is_skippable else false, b"}")
+            sink(b"".join(chunk))
+        sink(b"]")
@@ -0,0 +1,318 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Formatter which walks the parsed lxml tree exactly once.
+
+The regular Formatter serializes elements with html.tostring
+and parses the result again with BeautifulSoup. The Json it
+writes therefore carries a few traces of that round trip:
+text is taken from the repr of the serialized bytes (so a
+newline reads "\\n" and quotes may be escaped) and link
+targets are URI escaped by libxml2. This formatter collects
+the same strings straight from the tree and reproduces those
+traces, so its output is byte-identical. Elements whose round
+trip would be irregular (e.g. attribute values containing
+double quotes) fall back to the regular code path.
+"""
+
+import html as entities
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+from bs4 import BeautifulSoup
+from lxml import etree, html
+from wiki_objects import Links
+from format import (Formatter, HEADING_XPATH, CONTENT_XPATH, CATEGORIES_XPATH,
+                    NORM_DATA_XPATH, ARTICLE_ID_XPATH)
+
+
+def _hidden_tags() -> frozenset:
+    """Tags whose text BeautifulSoup leaves out of get_text.
+    This depends on the installed bs4 version."""
+    candidates = ["style", "script", "template", "rt", "rp", "noscript"]
+    return frozenset(tag for tag in candidates
+                     if BeautifulSoup(f"<p><{tag}>x</{tag}></p>", "html.parser").get_text() != "x")
+
+
+def _uri_escaping() -> Tuple[str, bool, bool]:
+    """Finds out how libxml2 escapes href values when serializing.
+    Returns the escaped ASCII characters, whether non-ASCII is
+    escaped and whether leading blanks are stripped."""
+    a = html.fromstring("<a>x</a>")
+    escaped = ""
+    for c in map(chr, [9, 10, 13] + list(range(32, 128))):
+        if c in "\"&<>":
+            continue
+        a.set("href", c)
+        if html.tostring(a) != f'<a href="{c}">x</a>'.encode():
+            escaped += c
+    a.set("href", "é")
+    non_ascii = html.tostring(a) != b'<a href="&#233;">x</a>'
+    a.set("href", " x")
+    strips = html.tostring(a) == b'<a href="x">x</a>'
+    return escaped, non_ascii, strips
+
+
+_HIDDEN = _hidden_tags()
+_URI_ESCAPED, _URI_NON_ASCII, _URI_STRIPS = _uri_escaping()
+_URI_ESCAPE = re.compile("[" + re.escape(_URI_ESCAPED)
+                         + ("\u0080-\U0010ffff" if _URI_NON_ASCII else "") + "]"
+                         ) if _URI_ESCAPED or _URI_NON_ASCII else None
+# Characters BeautifulSoup would not decode back to themselves
+_IRREGULAR = re.compile("[\u0080-\u009f]")
+# Attributes libxml2 writes without a value
+_BOOLEAN_ATTRIBUTES = frozenset(["checked", "compact", "declare", "defer", "disabled", "ismap",
+                                 "multiple", "nohref", "noresize", "noshade", "nowrap",
+                                 "readonly", "selected"])
+# What repr() does to the ASCII part of serialized bytes
+_REPR = {c: f"\\x{c:02x}" for c in list(range(32)) + [127]}
+_REPR.update({ord("\\"): "\\\\", ord("\t"): "\\t", ord("\n"): "\\n", ord("\r"): "\\r"})
+_REPR_QUOTED = dict(_REPR)
+_REPR_QUOTED[ord("'")] = "\\'"
+_REVISION_ID = re.compile(r"and revision id (\d+).*?")
+
+
+def _escape_uri(value: str) -> str:
+    if _URI_STRIPS:
+        value = value.lstrip(" \t\n\r")
+    if _URI_ESCAPE is None:
+        return value
+    return _URI_ESCAPE.sub(lambda m: "".join(f"%{b:02X}" for b in m.group().encode("utf-8")), value)
+
+
+def _is_noprint(attrib) -> bool:
+    """Checks if BeautifulSoup would write this span's start tag
+    as <span class="metadata noprint">."""
+    return len(attrib) == 1 and " ".join(attrib.get("class", "").split()) == "metadata noprint"
+
+
+class _Text:
+    """Collects what the serialize-and-reparse round trip of one
+    element would produce: its visible text, the text of its
+    links and which quotes the serialization contains."""
+
+    def __init__(self, tail: bool = True, noprints: bool = False):
+        self.pieces = []
+        self.hidden = []
+        self.attributes = []
+        self.links = []
+        self.quoted_attributes = False
+        self.irregular = False
+        self.tail = tail
+        self.noprints = noprints
+        self._table = None
+
+    def add_attributes(self, attrib):
+        for name, value in attrib.items():
+            self.attributes.append(value)
+            if name not in _BOOLEAN_ATTRIBUTES:
+                self.quoted_attributes = True
+            if '"' in value:
+                self.irregular = True
+
+    @property
+    def table(self) -> Dict[int, str]:
+        """The repr escaping which applied to this element."""
+        if self._table is None:
+            strings = "".join(self.pieces) + "".join(self.hidden) + "".join(self.attributes)
+            if _IRREGULAR.search(strings):
+                self.irregular = True
+            single = "'" in strings
+            double = self.quoted_attributes or '"' in strings
+            self._double = double or not single
+            self._table = _REPR_QUOTED if single and double else _REPR
+        return self._table
+
+    def text(self) -> str:
+        table = self.table
+        quote = "'" if self._double else '"'
+        return "b" + quote + "".join(self.pieces).translate(table) + quote
+
+    def link_text(self, start: int, end: int) -> str:
+        return "".join(self.pieces[start:end]).translate(self.table)
+
+
+class SinglePassFormatter(Formatter):
+
+    def __init__(self, language="de", fields: Optional[Iterable[str]] = None, serializer: str = "json"):
+        super().__init__(language, fields, serializer)
+        self._walked = None
+        self._landmarks = dict()
+        self._texts = dict()
+        self._revision_id = ""
+
+    def _walk(self):
+        """Visits every node of the tree once. Remembers the
+        elements the Formatter looks up by xpath, collects the text
+        of the content elements, the heading and the norm data and
+        reads the revision id from the comments."""
+        if self._walked is self.tree:
+            return
+        self._walked = self.tree
+        self._landmarks = dict()
+        self._texts = dict()
+        self._revision_id = ""
+        root = self.tree.getroot()
+        for element in reversed(list(root.itersiblings(preceding=True))):
+            self._visit(element, [], None)
+        self._visit(root, [], None)
+        for element in root.itersiblings():
+            self._visit(element, [], None)
+
+    def _landmark(self, xpath: str, element) -> bool:
+        if xpath in self._landmarks:
+            return False
+        self._landmarks[xpath] = element
+        return True
+
+    def _visit(self, element, active: List[Tuple[_Text, bool]], parent: Optional[str]):
+        tag = element.tag
+        if not isinstance(tag, str):
+            text = element.text
+            if text:
+                if tag is etree.Comment:
+                    match_obj = _REVISION_ID.search(text)
+                    if match_obj:
+                        self._revision_id = match_obj.group(1)
+                for collector, _ in active:
+                    collector.hidden.append(text)
+            return
+
+        attrib = element.attrib
+        role = None
+        own = None
+        if parent == "content" and self.filter_tags(tag):
+            own = self._texts[element] = _Text()
+        elif parent == "catlinks" and tag == "ul":
+            self._landmark(CATEGORIES_XPATH, element)
+        if attrib:
+            identifier = attrib.get("id")
+            if tag == "h1" and attrib.get("class") == "firstHeading":
+                if self._landmark(HEADING_XPATH, element):
+                    own = self._texts[element] = _Text(tail=False)
+            elif tag == "div" and attrib.get("class") == "mw-parser-output":
+                if self._landmark(CONTENT_XPATH, element):
+                    role = "content"
+            if identifier == "normdaten":
+                if self._landmark(NORM_DATA_XPATH, element):
+                    own = self._texts[element] = _Text(noprints=True)
+            elif identifier == "t-wikibase":
+                self._landmark(ARTICLE_ID_XPATH, element)
+            elif identifier == "mw-normal-catlinks":
+                role = "catlinks"
+        if own is not None:
+            active = active + [(own, True)]
+
+        hidden = tag in _HIDDEN
+        states = []
+        links = []
+        for collector, visible in active:
+            if attrib:
+                collector.add_attributes(attrib)
+            if visible:
+                if hidden:
+                    visible = False
+                    if len(element):
+                        collector.irregular = True
+                elif collector.noprints and tag == "span" and _is_noprint(attrib):
+                    visible = False
+                    if any(True for _ in element.iterdescendants("span")):
+                        collector.irregular = True
+                elif tag == "a":
+                    link = [element, len(collector.pieces)]
+                    collector.links.append(link)
+                    links.append((collector, link))
+            states.append((collector, visible))
+
+        text = element.text
+        if text:
+            for collector, visible in states:
+                (collector.pieces if visible else collector.hidden).append(text)
+        for child in element:
+            self._visit(child, states, role)
+            tail = child.tail
+            if tail:
+                for collector, visible in states:
+                    (collector.pieces if visible else collector.hidden).append(tail)
+        for collector, link in links:
+            link.append(len(collector.pieces))
+        if own is not None and element.tail:
+            (own.pieces if own.tail else own.hidden).append(element.tail)
+
+    def _find(self, xpath: str):
+        self._walk()
+        try:
+            return self._landmarks[xpath]
+        except KeyError:
+            raise IndexError(xpath)
+
+    def _get_element_text(self, element) -> Tuple[str, object]:
+        self._walk()
+        collector = self._texts[element]
+        text = collector.text()
+        if collector.irregular:
+            return super()._get_element_text(element)
+        return text, collector
+
+    def _get_element_links(self, source, text: str) -> Links:
+        if isinstance(source, str):
+            return super()._get_element_links(source, text)
+        table = source.table
+        hrefs = [(source.link_text(start, end),
+                  _escape_uri(a.attrib["href"]).translate(table),
+                  a.get("title").translate(table))
+                 for a, start, end in source.links if a.get("title")]
+        return self._get_link_offsets(hrefs, text)
+
+    def get_heading(self):
+        h1 = self._find(HEADING_XPATH)
+        collector = self._texts[h1]
+        collector.text()
+        if collector.irregular:
+            return super().get_heading()
+        return "".join(collector.pieces).translate(collector.table).strip()
+
+    def _get_category(self, li) -> Dict[str, str]:
+        if li.tag != "li" or li.attrib or li.text or len(li) != 1:
+            return super()._get_category(li)
+        a = li[0]
+        if a.tag != "a" or a.keys() != ["href", "title"] or len(a) or a.tail:
+            return super()._get_category(li)
+        link, title = a.values()
+        name = a.text or ""
+        strings = link + title + name + (li.tail or "")
+        if '"' in link + title or _IRREGULAR.search(strings) or not (_URI_NON_ASCII or link.isascii()):
+            return super()._get_category(li)
+        table = _REPR_QUOTED if "'" in strings else _REPR
+        return {"link": entities.escape(_escape_uri(link), quote=False).translate(table),
+                "category_name": entities.escape(title.translate(table), quote=False),
+                "display_name": entities.escape(name.translate(table), quote=False)}
+
+    def _format_norm_data(self, element) -> Optional[List[Dict[str, str]]]:
+        collector = self._texts[element]
+        text = collector.text()
+        if collector.irregular:
+            return super()._format_norm_data(element)
+        table = collector.table
+        a_tags = collector.links
+        types = a_tags[:-1:2]  # Is type like GND, NDL, VIAF
+        infos = a_tags[1::2]  # Is the actual number/id and its link
+        norm_data = []
+        if len(types) != len(infos):
+            return
+        search_obj = re.search(r"Normdaten.\((.*?)\):", text)
+        if search_obj:
+            norm_data.append({"norm_data_type": search_obj.group(1)})
+        for (_, type_start, type_end), (info, info_start, info_end) in zip(types, infos):
+            norm_data.append({'type': collector.link_text(type_start, type_end),
+                              'value': collector.link_text(info_start, info_end),
+                              'link': _escape_uri(info.attrib["href"]).translate(table)})
+        return norm_data
+
+    def get_revision_id(self):
+        self._walk()
+        return self._revision_id
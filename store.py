@@ -0,0 +1,164 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Append-only segment store for scraped articles.
+
+Articles are appended to segment files as Json lines, each
+line compressed as its own zstd frame, and a new segment is
+started once the current one exceeds segment_size bytes. A
+side index with one line per article
+
+    title \\t segment \\t offset \\t length \\t #written [\\t redirect ...]
+
+tells where each article is. Writes are collected in memory
+and written and synced in batches of buffer_size bytes; the
+index lines of a batch are written after its data, so the
+index never points at data that is not on disk.
+
+written is the time of the write in nanoseconds, so the reader
+can tell which of two copies of an article is the newer one,
+whichever files they are in. No title starts with "#", so the
+field is told apart from the redirects.
+"""
+
+import os
+import re
+import time
+from typing import List, Union
+from metrics import REGISTRY
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_SUFFIX = ".index"
+SEGMENT_SUFFIXES = {"zstd": ".jsonl.zst", "none": ".jsonl"}
+
+WRITE_SECONDS = REGISTRY.histogram("wiki_store_write_seconds", "Time to add an article to the store")
+FLUSH_SECONDS = REGISTRY.histogram("wiki_store_flush_seconds", "Time to write and sync a batch")
+BYTES_RAW = REGISTRY.counter("wiki_store_raw_bytes_total", "Bytes of Json handed to the store")
+BYTES_OUT = REGISTRY.counter("wiki_store_bytes_total", "Bytes written to the segments")
+
+
+class SegmentWriter:
+
+    def __init__(self,
+                 path: str,
+                 prefix: str,
+                 segment_size: int = 256 * 2**20,
+                 buffer_size: int = 8 * 2**20,
+                 compression: str = "zstd"
+                 ):
+
+        if compression not in SEGMENT_SUFFIXES:
+            raise Exception(f"Unknown compression {compression}.")
+        if compression == "zstd" and zstandard is None:
+            raise Exception("Compressed segments need the zstandard package.")
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._prefix = prefix
+        self._segment_size = segment_size
+        self._buffer_size = buffer_size
+        self._suffix = SEGMENT_SUFFIXES[compression]
+        self._compressor = zstandard.ZstdCompressor() if compression == "zstd" else None
+        self._buffer = bytearray()
+        self._entries = []
+        self._segment_no = self._last_segment()
+        self._segment = None
+        self._offset = 0
+        self._open_segment()
+        self._index = self._open_index(os.path.join(path, prefix + INDEX_SUFFIX))
+
+    @staticmethod
+    def _open_index(path: str):
+        """Opens an index for appending. A line a killed writer cut
+        short is cut off, so the next line does not run into it;
+        its article is not journaled and scraped again."""
+        with open(path, "ab+") as file:
+            end = file.seek(0, os.SEEK_END)
+            keep = end
+            while keep:
+                start = max(0, keep - 2**16)
+                file.seek(start)
+                newline = file.read(keep - start).rfind(b"\n")
+                if newline >= 0:
+                    keep = start + newline + 1
+                    break
+                keep = start
+            if keep < end:
+                file.truncate(keep)
+        return open(path, "a", encoding="utf-8")
+
+    def _segment_name(self, number: int) -> str:
+        return f"{self._prefix}-{number:05d}{self._suffix}"
+
+    def _last_segment(self) -> int:
+        """Finds the segment to continue writing to."""
+        pattern = re.compile(re.escape(self._prefix) + r"-(\d{5})" + re.escape(self._suffix) + "$")
+        numbers = [int(match_obj.group(1)) for match_obj in map(pattern.match, os.listdir(self._path))
+                   if match_obj]
+        return max(numbers, default=0)
+
+    def _open_segment(self):
+        if self._segment:
+            self._segment.close()
+        self._segment = open(os.path.join(self._path, self._segment_name(self._segment_no)), "ab")
+        self._offset = self._segment.tell()
+
+    def write(self, title: str, redirects: List[str], content: Union[str, bytes, bytearray]) -> bool:
+        """Adds an article, given as Json or as its UTF-8 bytes.
+        Returns True if this write flushed the buffer, i.e.
+        everything written so far is now on disk."""
+        with WRITE_SECONDS.time():
+            return self._write(title, redirects, content)
+
+    def _write(self, title: str, redirects: List[str], content: Union[str, bytes, bytearray]) -> bool:
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        record = content + b"\n"
+        BYTES_RAW.inc(len(record))
+        if self._compressor:
+            record = self._compressor.compress(record)
+        used = self._offset + len(self._buffer)
+        if used and used + len(record) > self._segment_size:
+            self.flush()
+            self._segment_no += 1
+            self._open_segment()
+        offset = self._offset + len(self._buffer)
+        self._buffer += record
+        self._entries.append("\t".join([title, self._segment_name(self._segment_no), str(offset),
+                                        str(len(record)), f"#{time.time_ns()}"] + redirects) + "\n")
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """Writes the buffered articles and their index lines."""
+        if not self._entries:
+            return
+        with FLUSH_SECONDS.time():
+            self._flush()
+
+    def _flush(self):
+        BYTES_OUT.inc(len(self._buffer))
+        self._segment.write(self._buffer)
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        self._offset += len(self._buffer)
+        self._buffer = bytearray()
+        self._index.writelines(self._entries)
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self._entries = []
+
+    def close(self):
+        self.flush()
+        self._segment.close()
+        self._index.close()
@@ -0,0 +1,252 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Runs a scrape as a set of supervised worker processes.
+
+The supervisor hosts the work queue of the scheduler and starts
+one Scraper process per worker. Every worker reports each title
+it finishes, and while it waits for work, as heartbeat. A worker
+which crashed or exited early is started again, one which has
+not reported anything for stall_timeout seconds is stopped and
+started again. The batches a dead worker held are handed out
+again right away.
+
+On SIGINT or SIGTERM the workers are asked to stop: they lease
+nothing new but still write, flush and journal the pages they
+have in flight. Only a worker still running after grace_period
+seconds is killed. close.py sends the signal.
+
+Workers are spawned, not forked: the supervisor already runs the
+threads of its stats, its log and, with the manager backend, the
+queue server, and a fork while one of them holds a lock would
+leave that lock held forever in the worker.
+"""
+
+import json
+import os
+import signal
+import time
+from datetime import datetime
+from multiprocessing import get_context
+from threading import Event
+from typing import Optional
+from logger import LOGGER, setup_logging
+from metrics import REGISTRY, start_stats
+from scheduler import open_queue
+from scraper import Scraper, worker_name
+from title_index import TitleIndex
+
+CONTEXT = get_context("spawn")
+RESTARTS = REGISTRY.counter("wiki_supervisor_restarts_total", "Workers started again, by reason", ["reason"])
+PID_FILE = "supervisor.pid"
+
+
+def _run_worker(language: str, number: int, workers: int, beats, titles):
+    """Runs one Scraper in a worker process. Slots number - 1 of
+    beats and titles hold the time of its last heartbeat and how
+    many titles it finished."""
+
+    # a group of its own, so its formatter processes can be killed with it
+    # and Ctrl-C reaches it only through the supervisor
+    os.setpgrp()
+    # ignored signals are inherited even by a spawned worker,
+    # the Scraper installs its own handlers once it runs
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def heartbeat(finished: int):
+        beats[number - 1] = time.time()
+        if finished:
+            with titles.get_lock():
+                titles[number - 1] += finished
+
+    Scraper(language, number, workers, heartbeat).scrape()
+
+
+class Worker:
+
+    def __init__(self, number: int):
+
+        self.number = number
+        self.process = None
+        self.stopped_at = None
+        self.restart_at = 0.0
+
+    @property
+    def name(self) -> Optional[str]:
+        return worker_name(self.number, self.process.pid) if self.process else None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def kill(self):
+        """Kills the worker together with its formatter processes."""
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class Supervisor:
+
+    def __init__(self,
+                 language: str = "de",
+                 workers: int = 1,
+                 stall_timeout: float = None
+                 ):
+
+        self._config = self._load_config()
+        self._settings = self._config["supervisor"]
+        self._language = language
+        self._stall_timeout = stall_timeout if stall_timeout else self._settings["stall_timeout"]
+        self._workers = [Worker(number) for number in range(1, workers + 1)]
+        self._beats = CONTEXT.Array("d", workers)
+        self._titles = CONTEXT.Array("q", workers)
+        self._stopping = Event()
+        self._queue = None
+
+    @staticmethod
+    def _load_config():
+        with open("config.json", "r") as file:
+            return json.loads(str(file.read()))
+
+    def stop(self, *args):
+        """Signal handler, asks all workers to stop."""
+        self._stopping.set()
+
+    def run(self):
+        """Supervises the workers until the scrape is finished or
+        a stop was requested."""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        stats = start_stats(self._config["metrics"], "supervisor")
+        logs = setup_logging(self._config["logging"], "supervisor")
+        index = TitleIndex(self._config["titles_path"])
+        self._queue = open_queue(self._config["scheduler"], index)
+        pid_file = self._config["state_path"] + PID_FILE
+        os.makedirs(self._config["state_path"], exist_ok=True)
+        with open(pid_file, "w") as file:
+            file.write(str(os.getpid()))
+        last_titles, last_time = 0, time.monotonic()
+        try:
+            for worker in self._workers:
+                self._start(worker)
+            while not self._stopping.wait(self._settings["interval"]):
+                finished = self._queue.finished()
+                for worker in self._workers:
+                    self._check(worker, finished)
+                if finished and not any(worker.is_alive() for worker in self._workers):
+                    break
+                now = time.monotonic()
+                last_titles, last_time = self._report(last_titles, now - last_time), now
+        finally:
+            self._shutdown()
+            index.close()
+            os.remove(pid_file)
+            if stats:
+                stats.stop()
+            if logs:
+                logs.stop()
+
+    def _start(self, worker: Worker):
+        self._beats[worker.number - 1] = time.time()
+        worker.process = CONTEXT.Process(target=_run_worker, name=f"scraper_{worker.number}",
+                                         args=(self._language, worker.number, len(self._workers),
+                                               self._beats, self._titles))
+        worker.process.start()
+        worker.stopped_at = None
+
+    def _check(self, worker: Worker, finished: bool):
+        """Starts a worker again if it died or stalled, unless all
+        batches are finished."""
+        now = time.monotonic()
+        if worker.is_alive():
+            if worker.stopped_at is not None:
+                # asked to stop because it stalled
+                if now - worker.stopped_at > self._settings["grace_period"]:
+                    worker.kill()
+            elif time.time() - self._beats[worker.number - 1] > self._stall_timeout:
+                self._restart(worker, "stalled")
+            return
+        if worker.process is None:
+            if not finished and now >= worker.restart_at:
+                self._start(worker)
+            return
+        exitcode = worker.process.exitcode
+        if worker.stopped_at is None and exitcode == 0 and finished:
+            return
+        self._restart(worker, "stalled" if worker.stopped_at is not None
+                      else "exited" if exitcode == 0 else "crashed")
+
+    def _restart(self, worker: Worker, reason: str):
+        """Stops a stalled worker or, once it is gone, hands its
+        batches out again and schedules its restart."""
+        if worker.is_alive():
+            LOGGER.warning("Worker %s stalled, stopping it.", worker.name,
+                           extra={"reason": "worker_stalled"})
+            worker.process.terminate()
+            worker.stopped_at = time.monotonic()
+            return
+        # formatter processes left behind by a worker which was killed
+        worker.kill()
+        released = self._queue.release(worker.name)
+        LOGGER.warning("Worker %s %s with exit code %s, releasing %s batches.", worker.name, reason,
+                       worker.process.exitcode, released,
+                       extra={"reason": f"worker_{reason}"})
+        RESTARTS.inc(reason=reason)
+        worker.process.close()
+        worker.process = None
+        worker.restart_at = time.monotonic() + self._settings["restart_delay"]
+
+    def _report(self, last_titles: int, elapsed: float) -> int:
+        """Prints the throughput since the last report and of each
+        worker, returns the titles finished so far."""
+        titles = sum(self._titles)
+        now = time.time()
+        states = []
+        for worker in self._workers:
+            if not worker.is_alive():
+                states.append(f"{worker.number}: down")
+            elif worker.stopped_at is not None:
+                states.append(f"{worker.number}: stopping")
+            else:
+                states.append(f"{worker.number}: {now - self._beats[worker.number - 1]:.0f}s")
+        status = self._queue.status()
+        given_up = f", {status['given_up']} given up" if status["given_up"] else ""
+        print(f"{str(datetime.now()).split('.')[0]}  {titles} titles, "
+              f"{(titles - last_titles) / max(elapsed, 1e-9):.1f}/s, "
+              f"batches {status['completed']}/{status['batches']}{given_up}  "
+              f"last heartbeat {', '.join(states)}")
+        return titles
+
+    def _shutdown(self):
+        """Asks the workers to stop and waits for them to write what
+        they have in flight, killing those which take too long."""
+        alive = [worker for worker in self._workers if worker.is_alive()]
+        for worker in alive:
+            worker.process.terminate()
+        deadline = time.monotonic() + self._settings["grace_period"]
+        for worker in alive:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                LOGGER.warning("Worker %s did not stop in time, killing it.", worker.name,
+                               extra={"reason": "worker_killed"})
+                worker.kill()
+                worker.process.join()
+
+
+def stop_supervisor(state_path: str) -> bool:
+    """Sends SIGTERM to the supervisor of a running scrape, returns
+    whether there was one."""
+    try:
+        with open(state_path + PID_FILE, "r") as file:
+            pid = int(file.read())
+        os.kill(pid, signal.SIGTERM)
+    except (OSError, ValueError):
+        return False
+    return True
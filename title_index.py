@@ -0,0 +1,145 @@
+"""
+Author: Marcel Braasch
+Email: marcelbraasch@gmail.com
+
+Goethe University Frankfurt
+Text Technology Lab
+Oktober 2019
+
+Binary index of main titles and their redirects.
+
+Layout (all integers little endian):
+    header      magic "WSTI", version (uint32), count (uint64)
+    offsets     count + 1 uint64 offsets into the string pool
+    sorted      count uint32 entry numbers ordered by title
+    lengths     count uint32 page lengths in bytes, 0 if unknown
+                (since version 2)
+    revisions   count uint32 latest revision ids, 0 if unknown
+                (since version 3)
+    pool        per entry the UTF-8 title and its redirects,
+                separated by newlines
+
+The file is memory-mapped, so a reader only touches the pages
+of the entries it actually looks at.
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+MAGIC = b"WSTI"
+VERSION = 3
+_HEADER = struct.Struct("<4sIQ")
+_OFFSET = struct.Struct("<Q")
+_NUMBER = struct.Struct("<I")
+
+
+def write_index(path: str, mapping: Dict[str, List[str]], pages: Optional[Dict[str, Tuple[int, int]]] = None):
+    """Writes a main title -> redirects mapping as index file,
+    optionally with the (page_len, page_latest) of every main
+    title."""
+    count = len(mapping)
+    records = ["\n".join([title] + redirects).encode("utf-8")
+               for title, redirects in mapping.items()]
+    offsets = array("Q", [0])
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    titles = [record.split(b"\n", 1)[0] for record in records]
+    order = array("I", sorted(range(count), key=titles.__getitem__))
+    pages = pages or dict()
+    sizes = array("I", [min(pages.get(title, (0, 0))[0], 2**32 - 1) for title in mapping])
+    revisions = array("I", [pages.get(title, (0, 0))[1] for title in mapping])
+    if order.itemsize != _NUMBER.size:
+        raise Exception("Unsupported platform for index files.")
+    if sys.byteorder == "big":
+        offsets.byteswap()
+        order.byteswap()
+        sizes.byteswap()
+        revisions.byteswap()
+    with open(path, "wb") as file:
+        file.write(_HEADER.pack(MAGIC, VERSION, count))
+        file.write(offsets.tobytes())
+        file.write(order.tobytes())
+        file.write(sizes.tobytes())
+        file.write(revisions.tobytes())
+        for record in records:
+            file.write(record)
+
+
+class TitleIndex:
+
+    def __init__(self, path: str):
+
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version not in (1, 2, VERSION):
+            raise Exception(f"{path} is not a title index.")
+        self._offsets = _HEADER.size
+        self._sorted = self._offsets + (self._count + 1) * _OFFSET.size
+        # the uint32 columns after sorted, lengths since version 2 and
+        # revisions since version 3
+        self._columns = self._sorted + self._count * _NUMBER.size
+        self._column_count = version - 1
+        self._pool = self._columns + self._column_count * self._count * _NUMBER.size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> Tuple[str, List[str]]:
+        """Returns the title and the redirects of an entry."""
+        title, *redirects = self._record(index).decode("utf-8").split("\n")
+        return title, redirects
+
+    def _column(self, number: int) -> array:
+        if number >= self._column_count:
+            return array("I", bytes(self._count * _NUMBER.size))
+        start = self._columns + number * self._count * _NUMBER.size
+        column = array("I", self._map[start:start + self._count * _NUMBER.size])
+        if sys.byteorder == "big":
+            column.byteswap()
+        return column
+
+    def lengths(self) -> array:
+        """Returns the page lengths of all entries, all 0 for an
+        index written without them."""
+        return self._column(0)
+
+    def revisions(self) -> array:
+        """Returns the latest revision ids of all entries, all 0 for
+        an index written without them."""
+        return self._column(1)
+
+    def _record(self, index: int) -> bytes:
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        start, = _OFFSET.unpack_from(self._map, self._offsets + index * _OFFSET.size)
+        end, = _OFFSET.unpack_from(self._map, self._offsets + (index + 1) * _OFFSET.size)
+        return self._map[self._pool + start:self._pool + end]
+
+    def _title(self, index: int) -> bytes:
+        return self._record(index).split(b"\n", 1)[0]
+
+    def find(self, title: str) -> Optional[int]:
+        """Returns the entry number of a main title by
+        binary search, or None if it is not in the index."""
+        key = title.encode("utf-8")
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            index, = _NUMBER.unpack_from(self._map, self._sorted + middle * _NUMBER.size)
+            if self._title(index) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            index, = _NUMBER.unpack_from(self._map, self._sorted + low * _NUMBER.size)
+            if self._title(index) == key:
+                return index
+        return None
+
+    def close(self):
+        self._map.close()
+
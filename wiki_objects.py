@@ -1,7 +1,22 @@
-from typing import Dict, List
+import re
+from array import array
+from typing import Dict, Iterator, List, Pattern
 
 class Skips:
 
+    # language -> compiled pattern, built once per process
+    _patterns = dict()
+
+    def pattern(self, language: str) -> Pattern:
+        """Returns one regex matching a heading if it contains
+        any of the skippables of the language. The "(Auswahl)"
+        variants contain their base word, so the base words are
+        enough to decide."""
+        if language not in Skips._patterns:
+            skips = sorted(set(self.get(language) or []), key=len, reverse=True)
+            Skips._patterns[language] = re.compile("|".join(map(re.escape, skips)) or "(?!)")
+        return Skips._patterns[language]
+
     def get(self, language: str) -> List[str]:
 
         if language == "de":
@@ -31,9 +46,12 @@ class Skips:
 
 class Heading:
 
-    def __init__(self, text):
+    __slots__ = ("_text", "_subheadings", "_is_skippable")
+
+    def __init__(self, text, is_skippable: bool = False):
         self._text = text
         self._subheadings = []
+        self._is_skippable = is_skippable
 
     def add_subheading(self, sub):
         self._subheadings.append(sub)
@@ -46,6 +64,10 @@ class Heading:
     def subheadings(self):
         return self._subheadings
 
+    @property
+    def is_skippable(self):
+        return self._is_skippable
+
     @classmethod
     def to_dict(cls, _obj):
 
@@ -59,22 +81,80 @@ class Heading:
         return _to_dict(_obj)
 
 
+class Links:
+    """The links of one paragraph as parallel arrays: the start
+    and end offsets of each link in the paragraph text and its
+    link and article name. These are interned in strings, one
+    dict per article, so a target linked from many paragraphs
+    is held once. The display name is the text between the
+    offsets. Reads like a list of dicts with the keys link,
+    display_name, article_name, start and end."""
+
+    __slots__ = ("_text", "_starts", "_ends", "_links", "_names", "_strings")
+
+    def __init__(self, text: str, strings: Dict[str, str] = None):
+        self._text = text
+        self._starts = array("I")
+        self._ends = array("I")
+        self._links = []
+        self._names = []
+        self._strings = strings if strings is not None else dict()
+
+    def append(self, link: str, article_name: str, start: int, end: int):
+        strings = self._strings
+        self._starts.append(start)
+        self._ends.append(end)
+        self._links.append(strings.setdefault(link, link))
+        self._names.append(strings.setdefault(article_name, article_name))
+
+    @property
+    def starts(self) -> array:
+        return self._starts
+
+    @property
+    def ends(self) -> array:
+        return self._ends
+
+    @property
+    def links(self) -> List[str]:
+        return self._links
+
+    @property
+    def article_names(self) -> List[str]:
+        return self._names
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, index: int) -> Dict[str, object]:
+        start, end = self._starts[index], self._ends[index]
+        return {'link': self._links[index],
+                'display_name': self._text[start:end],
+                'article_name': self._names[index],
+                'start': start,
+                'end': end}
+
+    def __iter__(self) -> Iterator[Dict[str, object]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def to_list(self) -> List[Dict[str, object]]:
+        return list(self)
+
+
 class Paragraph:
 
+    __slots__ = ("_text", "_headings", "_links", "_is_list", "_is_skippable")
+
     def __init__(self, text: str,
                  h1: Heading,
                  h2: Heading = None, h3: Heading = None, h4: Heading = None,
                  h5: Heading = None, h6: Heading = None,
-                 links: List[Dict[str, str]] = None,
+                 links: Links = None,
                  is_list: bool = False,
                  is_skippable: bool = False):
         self._text = text
-        self._h1 = h1
-        self._h2 = h2
-        self._h3 = h3
-        self._h4 = h4
-        self._h5 = h5
-        self._h6 = h6
+        self._headings = (h1, h2, h3, h4, h5, h6)
         self._links = links
         self._is_list = is_list
         self._is_skippable = is_skippable
@@ -96,26 +176,31 @@ class Paragraph:
     def text(self):
         return self._text
 
+    @property
+    def headings(self):
+        """h1 to h6, None where there is none."""
+        return self._headings
+
     @property
     def h1(self):
-        return self._h1
+        return self._headings[0]
 
     @property
     def h2(self):
-        return self._h2
+        return self._headings[1]
 
     @property
     def h3(self):
-        return self._h3
+        return self._headings[2]
 
     @property
     def h4(self):
-        return self._h4
+        return self._headings[3]
 
     @property
     def h5(self):
-        return self._h5
+        return self._headings[4]
 
     @property
     def h6(self):
-        return self._h6
\ No newline at end of file
+        return self._headings[5]